@@ -0,0 +1,652 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import io
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import datetime
+import uuid
+import random
+import sqlite3
+import threading
+import urllib.parse
+import collections
+from ShoppingListDB import ShoppingListDB
+from ItemSearchIndex import ItemSearchIndex
+from Metrics import Metrics
+from StaticSnapshot import StaticSnapshot
+from ListPool import ListPool
+from Suggestions import Suggestions
+from WriteQueue import WriteQueue
+
+class APIServer():
+	Request = collections.namedtuple("Request", [ "method", "path", "query", "auth_user", "post_data", "environ", "context" ])
+	Response = collections.namedtuple("Response", [ "status", "headers", "body" ])
+	_LISTID_RE = re.compile(r"[A-Za-z0-9_-]+")
+
+	# List id under which lists.users grants access to the database given by
+	# "database"; also reachable below /lists/default/.
+	_DEFAULT_LISTID = "default"
+
+	# Routes that concern the server as a whole instead of one list.
+	_SERVER_ROUTES = [ "/lists", "/metrics" ]
+
+	# Under CGI, every open event stream keeps a Python process alive. There,
+	# /events is answered like a short long-poll instead: the stream ends
+	# after the first change or the timeout and the client reconnects after
+	# the retry interval.
+	_CGI_EVENT_TIMEOUT_SECS = 5
+	_CGI_EVENT_RETRY_MS = 10000
+
+	class ListContext():
+		# Everything that belongs to one shopping list: its database and the
+		# caches derived from it. The lock guards the read connection of the
+		# database and the caches, the write lock guards its write connection;
+		# reads therefore never wait for a writer that waits for SQLite's
+		# write lock. Both may only be acquired in the order write lock, lock.
+		# The changed condition is notified after every committed change.
+		def __init__(self, listid, database, snapshot = None, archive_filename = None):
+			self.listid = listid
+			self.database = database
+			self.snapshot = snapshot
+			self.snapshot_outdated = False
+			self.archive_filename = archive_filename
+			self.all_cache = { }
+			self.search_index = None
+			self.write_queue = None
+			self.lock = threading.Lock()
+			self.write_lock = threading.Lock()
+			self.changed = threading.Condition()
+			self.change_generation = 0
+
+	def __init__(self, config, persistent = False):
+		self._config = config
+		self._persistent = persistent
+		self._metrics = Metrics()
+		self._metrics.describe("pyslist_request_duration_seconds", "Time taken to process an API request.")
+		self._metrics.describe("pyslist_response_size_bytes", "Size of API response bodies.")
+		self._metrics.describe("pyslist_sql_statement_seconds", "Execution time of SQL statements.")
+		self._metrics.describe("pyslist_sql_statement_rows_total", "Rows returned or modified by SQL statements.")
+		self._metrics.describe("pyslist_sql_lock_wait_seconds", "Time spent waiting to begin a database transaction.")
+		self._metrics.describe("pyslist_sql_lock_errors_total", "SQL statements that failed because the database was locked.")
+		self._lists = self._config.lists
+
+		# Only guards the pool of list contexts; everything else is locked
+		# per list (see ListContext).
+		self._pool_lock = threading.Lock()
+
+		# Requests without a list id in their path go to the database of the
+		# configuration file; every other list is kept in its own database
+		# file (shard) in the lists directory.
+		snapshot = StaticSnapshot(self._config.snapshot_filename) if (self._config.snapshot_filename is not None) else None
+		self._default_context = self._open_context(None, self._config.db_filename, snapshot = snapshot, archive_filename = self._config.compaction["archive"])
+		self._list_pool = ListPool(self._open_list_context, capacity = self._lists["pool_size"], close_context = self._close_context)
+
+	def _open_database(self, db_filename, context):
+		checkpoints = self._config.checkpoints
+		database = ShoppingListDB(sqlite_dbfile = db_filename, options = self._config.sqlite_options, metrics = self._metrics, slow_query_threshold = self._config.slow_query_threshold, checkpoint_transactions = checkpoints["transactions"], checkpoint_minutes = checkpoints["minutes"])
+		database.add_change_listener(lambda changeno: self._on_database_change(context, changeno))
+		return database
+
+	def _open_context(self, listid, db_filename, snapshot = None, archive_filename = None):
+		context = self.ListContext(listid, None, snapshot = snapshot, archive_filename = archive_filename)
+		context.database = self._open_database(db_filename, context)
+		write_queue = self._config.write_queue
+		if write_queue is not None:
+			# The writer thread uses a database connection of its own.
+			context.write_queue = WriteQueue(lambda: self._open_database(db_filename, context), delay = write_queue["delay_ms"] / 1000, max_batch = write_queue["max_batch"])
+		return context
+
+	def _close_context(self, context):
+		if context.write_queue is not None:
+			context.write_queue.close()
+
+	def _open_list_context(self, listid):
+		os.makedirs(self._lists["directory"], exist_ok = True)
+		db_filename = "%s/%s.sqlite3" % (self._lists["directory"], listid)
+		archive_filename = "%s/%s.archive.sqlite3" % (self._lists["directory"], listid) if (self._config.compaction["archive"] is not None) else None
+		return self._open_context(listid, db_filename, archive_filename = archive_filename)
+
+	def _get_permitted_lists(self, auth_user):
+		# Without any users configured for lists, there is only the default
+		# list and every authenticated user may access it.
+		if len(self._lists["users"]) == 0:
+			return [ self._DEFAULT_LISTID ]
+		return self._lists["users"].get(auth_user, [ ])
+
+	def _on_database_change(self, context, changeno):
+		# Called with the write lock held or from the writer thread of a
+		# write queue.
+		with context.changed:
+			context.snapshot_outdated = True
+			context.change_generation += 1
+			context.changed.notify_all()
+
+	def _wait_for_change(self, context, since, timeout):
+		# Must be called without holding any lock of the context. Changes made
+		# through this instance wake up waiters immediately, changes made by
+		# other processes (e.g., CGI requests or the command line tool) are
+		# noticed by polling the change number once per second.
+		deadline = time.monotonic() + timeout
+		with context.changed:
+			generation = context.change_generation
+		with context.lock:
+			changeno = context.database.get_changeno()
+		while changeno <= since:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			with context.changed:
+				if context.change_generation == generation:
+					context.changed.wait(min(remaining, 1))
+				generation = context.change_generation
+			with context.lock:
+				changeno = context.database.get_changeno()
+		return changeno
+
+	@staticmethod
+	def _get_store_order_format(request):
+		store_order = request.query.get("store_order", "map")
+		if store_order not in [ "map", "list" ]:
+			raise ValueError("Unsupported store_order '%s', must be either 'map' or 'list'." % (store_order))
+		return store_order
+
+	@classmethod
+	def _get_all_representation(cls, request):
+		# "map" or "list" (see store_order) or "columnar" for parallel arrays
+		data_format = request.query.get("format")
+		if data_format is None:
+			return cls._get_store_order_format(request)
+		elif data_format == "columnar":
+			return data_format
+		else:
+			raise ValueError("Unsupported format '%s', must be 'columnar' if given." % (data_format))
+
+	def _get_all_snapshot(self, context, representation, changeno):
+		# The serialized /all response is cached per representation and only
+		# rebuilt when the change number of the database has advanced.
+		snapshot = context.all_cache.get(representation)
+		if (snapshot is None) or (snapshot["changeno"] != changeno):
+			if representation == "columnar":
+				data = context.database.get_all_columnar()
+			else:
+				data = context.database.get_all(compact = (representation == "list"))
+			body = StaticSnapshot.encode(data)
+			snapshot = {
+				"changeno":		data["changeno"],
+				"body":			body,
+				"gzip_body":	None,
+			}
+			context.all_cache[representation] = snapshot
+		return snapshot
+
+	@staticmethod
+	def _etag_matches(environ, etag):
+		if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+		if if_none_match is None:
+			return False
+		candidates = [ candidate.strip() for candidate in if_none_match.split(",") ]
+		candidates = [ candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates ]
+		return ("*" in candidates) or (etag in candidates)
+
+	@staticmethod
+	def _all_etag(representation, changeno, use_gzip):
+		return "\"all-%s-%d%s\"" % (representation, changeno, "-gzip" if use_gzip else "")
+
+	def _execute_GET_all_at(self, request, representation):
+		# Historical views are reconstructed on every request, they are
+		# neither cached nor tagged.
+		at = datetime.datetime.strptime(request.query["at"], "%Y-%m-%dT%H:%M:%SZ")
+		with request.context.lock:
+			if representation == "columnar":
+				data = request.context.database.get_all_columnar(at = at)
+			else:
+				data = request.context.database.get_all(compact = (representation == "list"), at = at)
+		return self.Response(status = "200 OK", headers = [ ("Content-Type", "application/json"), ("Cache-Control", "no-cache") ], body = StaticSnapshot.encode(data))
+
+	def _execute_GET_all(self, request):
+		representation = self._get_all_representation(request)
+		if "at" in request.query:
+			return self._execute_GET_all_at(request, representation)
+		use_gzip = "gzip" in request.environ.get("HTTP_ACCEPT_ENCODING", "")
+		headers = [
+			("Cache-Control", "no-cache"),
+			("Vary", "Accept-Encoding"),
+		]
+
+		# Revalidation only needs the change number; the response body is not
+		# built (which is expensive when nothing is cached, e.g., under CGI).
+		with request.context.lock:
+			changeno = request.context.database.get_changeno()
+			etag = self._all_etag(representation, changeno, use_gzip)
+			if self._etag_matches(request.environ, etag):
+				return self.Response(status = "304 Not Modified", headers = [ ("ETag", etag) ] + headers, body = b"")
+
+			# Another process may have committed in the meantime, the ETag
+			# always describes the body that is actually sent.
+			snapshot = self._get_all_snapshot(request.context, representation, changeno)
+			headers = [ ("ETag", self._all_etag(representation, snapshot["changeno"], use_gzip)) ] + headers
+			headers.append(("Content-Type", "application/json"))
+			if use_gzip:
+				if snapshot["gzip_body"] is None:
+					snapshot["gzip_body"] = gzip.compress(snapshot["body"])
+				headers.append(("Content-Encoding", "gzip"))
+				body = snapshot["gzip_body"]
+			else:
+				body = snapshot["body"]
+		return self.Response(status = "200 OK", headers = headers, body = body)
+
+	def _get_search_index(self, context):
+		# The index is rebuilt when items or aliases changed. Purchase
+		# frequencies only influence the ranking, they are taken from the
+		# incrementally maintained statistics at most every few minutes.
+		with context.lock:
+			catalog_changeno = context.database.get_catalog_changeno()
+			search_index = context.search_index
+		now = time.monotonic()
+		if (search_index is None) or (search_index["catalog_changeno"] != catalog_changeno) or (now - search_index["created"] > 300):
+			with context.write_lock:
+				context.database.refresh_statistics()
+			with context.lock:
+				search_index = {
+					"catalog_changeno":	catalog_changeno,
+					"created":			now,
+					"index":			ItemSearchIndex(context.database.get_item_names(), frequencies = context.database.get_purchase_frequencies()),
+				}
+				context.search_index = search_index
+		return search_index["index"]
+
+	def _execute_GET_search(self, request):
+		limit = min(int(request.query.get("limit", "10")), 100)
+		# parse_qsl() drops parameters with blank values, i.e., "?q=" arrives
+		# as a missing term.
+		term = request.query.get("q", "")
+		if term.strip() == "":
+			results = [ ]
+		else:
+			results = self._get_search_index(request.context).search(term, limit = limit)
+		return {
+			"success": True,
+			"msg": "search",
+			"results": [ { "itemid": itemid, "name": item_name, "matched": matched_name } for (itemid, item_name, matched_name) in results ],
+		}
+
+	def _execute_GET_list(self, request):
+		with request.context.lock:
+			(changeno, entries) = request.context.database.get_sorted_shopping_list(request.query.get("store"))
+		return {
+			"success": True,
+			"msg": "list",
+			"changeno": changeno,
+			"store": request.query.get("store"),
+			"items": [ { "itemid": itemid, "name": item_name, "count": count, "section": section } for (itemid, item_name, count, section) in entries ],
+		}
+
+	def _execute_GET_suggestions(self, request):
+		database = request.context.database
+		limit = min(int(request.query.get("limit", "10")), 100)
+		with request.context.write_lock:
+			database.refresh_statistics()
+		with request.context.lock:
+			suggestions = Suggestions(database.get_item_statistics(), database.get_shopping_list(), database.get_shopping_list_cooccurrences())
+		return {
+			"success": True,
+			"msg": "suggestions",
+			"due": suggestions.due(limit = limit),
+			"related": suggestions.related(limit = limit),
+		}
+
+	def _execute_GET_changes(self, request):
+		since = int(request.query["since"])
+		with request.context.lock:
+			changes = request.context.database.get_changes(since, compact = (self._get_store_order_format(request) == "list"))
+		return {
+			"success": True,
+			"msg": "changes",
+			"data": changes,
+		}
+
+	def _event_stream(self, context, since, compact):
+		# The stream is closed after a while; EventSource clients then
+		# reconnect and resume through the Last-Event-ID header.
+		if self._persistent:
+			(duration, keepalive, retry_ms) = (300, 15, 2000)
+		else:
+			(duration, keepalive, retry_ms) = (self._CGI_EVENT_TIMEOUT_SECS, self._CGI_EVENT_TIMEOUT_SECS, self._CGI_EVENT_RETRY_MS)
+		end_time = time.monotonic() + duration
+		yield ("retry: %d\n\n" % (retry_ms)).encode("ascii")
+		while time.monotonic() < end_time:
+			changeno = self._wait_for_change(context, since, timeout = min(keepalive, max(end_time - time.monotonic(), 0)))
+			if changeno > since:
+				with context.lock:
+					changes = context.database.get_changes(since, compact = compact)
+			else:
+				changes = None
+			if changes is None:
+				yield b": keepalive\n\n"
+			else:
+				since = changes["changeno"]
+				yield ("id: %d\nevent: changes\ndata: %s\n\n" % (since, json.dumps(changes, separators = (",", ":")))).encode("utf-8")
+				if not self._persistent:
+					break
+
+	def _execute_GET_events(self, request):
+		# Server-Sent Events stream of changes after the given change number.
+		# With "poll" given, the request is instead answered once (like
+		# /changes) as soon as a change occurred or the timeout expired.
+		last_event_id = request.environ.get("HTTP_LAST_EVENT_ID")
+		since = int(last_event_id) if last_event_id else int(request.query["since"])
+		compact = (self._get_store_order_format(request) == "list")
+		if "poll" in request.query:
+			timeout = min(float(request.query.get("timeout", "25")), 60 if self._persistent else self._CGI_EVENT_TIMEOUT_SECS)
+			self._wait_for_change(request.context, since, timeout)
+			with request.context.lock:
+				changes = request.context.database.get_changes(since, compact = compact)
+			return {
+				"success": True,
+				"msg": "changes",
+				"data": changes,
+				"retry_ms": 0 if self._persistent else self._CGI_EVENT_RETRY_MS,
+			}
+		headers = [
+			("Content-Type", "text/event-stream"),
+			("Cache-Control", "no-cache"),
+			("X-Accel-Buffering", "no"),
+		]
+		return self.Response(status = "200 OK", headers = headers, body = self._event_stream(request.context, since, compact))
+
+	def _execute_GET_metrics(self, request):
+		return self.Response(status = "200 OK", headers = [ ("Content-Type", "text/plain; version=0.0.4") ], body = self._metrics.render().encode("utf-8"))
+
+	def _execute_POST_transaction(self, request):
+		# Introduce random error
+#		if random.randint(0, 3) != 0:
+#			raise Exception("CALL FAILED")
+
+		transactionid = str(uuid.UUID(request.post_data.get("transactionid")))
+		delta = int(request.post_data.get("delta"))
+		if "item_name" in request.post_data:
+			# The item is resolved (and possibly created) by name
+			item_name = str(request.post_data["item_name"])
+			create = bool(request.post_data.get("create", True))
+			if request.context.write_queue is not None:
+				(status, itemid) = request.context.write_queue.submit(("named_transaction", transactionid, item_name, delta, request.auth_user, create))
+			else:
+				with request.context.write_lock:
+					(status, itemid) = request.context.database.process_named_transaction(transactionid = transactionid, item_name = item_name, delta = delta, user = request.auth_user, create = create)
+			return {
+				"success": True,
+				"msg": "transaction",
+				"transactionid": transactionid,
+				"itemid": itemid,
+				"status": status,
+			}
+
+		itemid = int(request.post_data.get("itemid"))
+		if request.context.write_queue is not None:
+			status = request.context.write_queue.submit(("transaction", transactionid, itemid, delta, request.auth_user))
+		else:
+			with request.context.write_lock:
+				status = request.context.database.process_transaction(transactionid = transactionid, itemid = itemid, delta = delta, user = request.auth_user)
+		return {
+			"success": True,
+			"msg": "transaction",
+			"transactionid": transactionid,
+			"status": status,
+		}
+
+	def _execute_POST_transactions(self, request):
+		transactions = [ ]
+		for transaction in request.post_data["transactions"]:
+			transactionid = str(uuid.UUID(transaction.get("transactionid")))
+			itemid = int(transaction.get("itemid"))
+			delta = int(transaction.get("delta"))
+			transactions.append((transactionid, itemid, delta))
+		if request.context.write_queue is not None:
+			results = request.context.write_queue.submit_many([ ("transaction", transactionid, itemid, delta, request.auth_user) for (transactionid, itemid, delta) in transactions ])
+			for (index, result) in enumerate(results):
+				if isinstance(result, sqlite3.IntegrityError):
+					# Same status as process_transactions() reports
+					results[index] = "rejected"
+				elif isinstance(result, Exception):
+					raise result
+			with request.context.lock:
+				changeno = request.context.database.get_changeno()
+		else:
+			with request.context.write_lock:
+				results = request.context.database.process_transactions(transactions, user = request.auth_user)
+				with request.context.lock:
+					changeno = request.context.database.get_changeno()
+		# Clients keep applied transactions in their queue until their copy
+		# of the list includes this change number.
+		return {
+			"success": True,
+			"msg": "transactions",
+			"changeno": changeno,
+			"results": [ { "transactionid": transactionid, "status": status } for ((transactionid, itemid, delta), status) in zip(transactions, results) ],
+		}
+
+	def _execute_GET_debug(self, request):
+		return {
+			"success": True,
+			"msg": "debug",
+			"data": {
+				"env":			{ key: value for (key, value) in request.environ.items() if isinstance(value, str) },
+				"query":		request.query,
+				"post_data":	request.post_data,
+				"auth_user":	request.auth_user,
+			},
+		}
+
+	def _execute_POST_item(self, request):
+		if request.context.write_queue is not None:
+			itemid = request.context.write_queue.submit(("add_item", request.post_data["name"]))
+		else:
+			with request.context.write_lock:
+				itemid = request.context.database.add_item(request.post_data["name"])
+		return {
+			"success": True,
+			"msg": "add_item",
+			"itemid": itemid,
+		}
+
+	def _execute_GET_lists(self, request):
+		return {
+			"success": True,
+			"msg": "lists",
+			"lists": self._get_permitted_lists(request.auth_user),
+		}
+
+	def _update_snapshot(self, context):
+		if (context.snapshot is None) or (not context.snapshot_outdated):
+			return
+		context.snapshot_outdated = False
+		try:
+			context.snapshot.update(context.database, read_lock = context.lock)
+		except Exception as e:
+			# The change itself has already been committed; clients fall back
+			# to the API if the snapshot cannot be written.
+			print("pyslist: updating snapshot %s failed: %s" % (context.snapshot.filename, str(e)), file = sys.stderr)
+
+	def _auto_compact(self, context):
+		compaction = self._config.compaction
+		if compaction["auto_interval_hours"] is None:
+			return
+		with context.lock:
+			last_compaction_utc = context.database.get_property("last_compaction_utc")
+		if last_compaction_utc is not None:
+			last_compaction_utc = datetime.datetime.strptime(last_compaction_utc, "%Y-%m-%dT%H:%M:%SZ")
+			if datetime.datetime.utcnow() - last_compaction_utc < datetime.timedelta(hours = compaction["auto_interval_hours"]):
+				return
+		try:
+			# A full VACUUM would block this request and all other writers,
+			# it is left to "pyslist_cli.py compact".
+			with context.write_lock:
+				context.database.compact_history(retention_days = compaction["retention_days"], archive_filename = context.archive_filename, vacuum = False)
+		except Exception as e:
+			# The request itself succeeded, do not report failure to the client.
+			print("pyslist: automatic history compaction failed: %s" % (str(e)), file = sys.stderr)
+
+	def _get_auth_user(self, environ):
+		return environ.get("REMOTE_USER")
+
+	@staticmethod
+	def _read_post_data(environ, input_stream):
+		content_length = environ.get("CONTENT_LENGTH")
+		if content_length:
+			data = input_stream.read(int(content_length))
+		else:
+			data = input_stream.read()
+		return json.loads(data)
+
+	def execute(self, environ, input_stream):
+		request_method = environ.get("REQUEST_METHOD")
+		if request_method is not None:
+			request_method = request_method.upper()
+		path_info = environ.get("PATH_INFO")
+		query = dict(urllib.parse.parse_qsl(environ.get("QUERY_STRING", "")))
+		auth_user = self._get_auth_user(environ)
+
+		if auth_user is None:
+			return {
+				"success": False,
+				"error_text": "Cannot determine authenticated user.",
+			}
+
+		if request_method == "POST":
+			# Decode POST data as JSON
+			try:
+				post_data = self._read_post_data(environ, input_stream)
+			except json.decoder.JSONDecodeError as e:
+				return {
+					"success": False,
+					"error_text": "JSON decoding error: %s" % (str(e)),
+				}
+		else:
+			post_data = None
+
+		if (path_info is not None) and path_info.startswith("/lists/"):
+			(listid, _, path_info) = path_info[len("/lists/") : ].partition("/")
+			path_info = "/" + path_info
+		elif path_info in self._SERVER_ROUTES:
+			listid = None
+		else:
+			listid = self._DEFAULT_LISTID
+
+		if listid is not None:
+			if (self._LISTID_RE.fullmatch(listid) is None) or (listid not in self._get_permitted_lists(auth_user)):
+				return {
+					"success": False,
+					"error_text": "User %s is not permitted to access list %s." % (auth_user, listid),
+				}
+		if (listid is None) or (listid == self._DEFAULT_LISTID):
+			context = self._default_context
+		else:
+			with self._pool_lock:
+				context = self._list_pool.get(listid)
+
+		request = self.Request(method = request_method, path = path_info, query = query, auth_user = auth_user, post_data = post_data, environ = environ, context = context)
+		environ["pyslist.route"] = path_info
+		if (request_method == "GET") and (path_info == "/all"):
+			response = self._execute_GET_all(request)
+		elif (request_method == "GET") and (path_info == "/search"):
+			response = self._execute_GET_search(request)
+		elif (request_method == "GET") and (path_info == "/list"):
+			response = self._execute_GET_list(request)
+		elif (request_method == "GET") and (path_info == "/suggestions"):
+			response = self._execute_GET_suggestions(request)
+		elif (request_method == "GET") and (path_info == "/changes"):
+			response = self._execute_GET_changes(request)
+		elif (request_method == "GET") and (path_info == "/events"):
+			response = self._execute_GET_events(request)
+		elif (request_method == "POST") and (path_info == "/transaction"):
+			response = self._execute_POST_transaction(request)
+		elif (request_method == "POST") and (path_info == "/transactions"):
+			response = self._execute_POST_transactions(request)
+		elif (request_method == "GET") and (path_info == "/debug") and (self._config.debug):
+			response = self._execute_GET_debug(request)
+		elif (request_method == "POST") and (path_info == "/item"):
+			response = self._execute_POST_item(request)
+		elif (request_method == "GET") and (path_info == "/metrics"):
+			response = self._execute_GET_metrics(request)
+		elif (request_method == "GET") and (path_info == "/lists"):
+			response = self._execute_GET_lists(request)
+		else:
+			environ["pyslist.route"] = "unknown"
+			response = {
+				"success": False,
+				"error_text": "Unknown or unsupported REQUEST_METHOD %s / PATH_INFO %s" % (str(request_method), str(path_info)),
+			}
+
+		if request_method == "POST":
+			self._update_snapshot(context)
+			self._auto_compact(context)
+		return response
+
+	@classmethod
+	def json_response(cls, response, debug = False):
+		if (not debug) and ("error_text" in response):
+			response["error_text"] = "Error details unavailable with disabled debugging."
+		status = "200 OK" if response["success"] else "400 Bad Request"
+		body = json.dumps(response, separators = (",", ":")).encode("utf-8")
+		return cls.Response(status = status, headers = [ ("Content-Type", "application/json") ], body = body)
+
+	def handle(self, environ, input_stream):
+		# The body of the returned response is either bytes or, for streamed
+		# responses, an iterable of bytes.
+		t0 = time.perf_counter()
+		try:
+			response = self.execute(environ, input_stream)
+		except Exception as e:
+			response = {
+				"success": False,
+				"error_text": "Exception: %s" % (str(e)),
+			}
+		if not isinstance(response, self.Response):
+			response = self.json_response(response, debug = self._config.debug)
+
+		labels = {
+			"method":	str(environ.get("REQUEST_METHOD")),
+			"route":	environ.get("pyslist.route", "unknown"),
+			"status":	response.status.split()[0],
+		}
+		self._metrics.observe("pyslist_request_duration_seconds", time.perf_counter() - t0, labels = labels, buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+		if isinstance(response.body, bytes):
+			self._metrics.observe("pyslist_response_size_bytes", len(response.body), labels = { "route": labels["route"] }, buckets = (100, 1000, 10000, 100000, 1000000))
+		return response
+
+	def __call__(self, environ, start_response):
+		# WSGI entry point; the instance (and with it the configuration and
+		# database connection) stays alive across requests. Without a
+		# Content-Length, WSGI does not permit reading the input stream.
+		input_stream = environ["wsgi.input"] if environ.get("CONTENT_LENGTH") else io.BytesIO()
+		response = self.handle(environ, input_stream)
+		if isinstance(response.body, bytes):
+			start_response(response.status, response.headers + [ ("Content-Length", str(len(response.body))) ])
+			return [ response.body ]
+		else:
+			start_response(response.status, response.headers)
+			return response.body
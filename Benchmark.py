@@ -0,0 +1,248 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import sqlite3
+import datetime
+import tempfile
+import multiprocessing
+from Configuration import Configuration
+from ShoppingListDB import ShoppingListDB
+from APIServer import APIServer
+
+def _concurrent_transaction_worker(arguments):
+	(dbfile, options, itemids, count, seed) = arguments
+	rng = random.Random(seed)
+	db = ShoppingListDB(dbfile, options = options)
+	latencies = [ ]
+	for i in range(count):
+		t0 = time.perf_counter()
+		db.process_transaction(str(uuid.UUID(int = rng.getrandbits(128), version = 4)), itemid = rng.choice(itemids), delta = 1, user = "bench%d" % (seed))
+		latencies.append(time.perf_counter() - t0)
+	return latencies
+
+class Benchmark():
+	_DEFAULT_PARAMETERS = {
+		"items":			2000,
+		"aliases":			200,
+		"stores":			20,
+		"order_length":		500,
+		"history":			100000,
+		"history_days":		365,
+		"users":			4,
+		"iterations":		200,
+		"processes":		4,
+		"seed":				1,
+	}
+
+	def __init__(self, workdir = None, **parameters):
+		self._parameters = dict(self._DEFAULT_PARAMETERS)
+		self._parameters.update(parameters)
+		self._rng = random.Random(self._parameters["seed"])
+		if workdir is None:
+			self._tempdir = tempfile.TemporaryDirectory(prefix = "pyslist_bench_")
+			workdir = self._tempdir.name
+		self._workdir = workdir
+		self._dbfile = os.path.join(self._workdir, "bench.sqlite3")
+		self._config_filename = os.path.join(self._workdir, "bench_config.json")
+		with open(self._config_filename, "w") as f:
+			json.dump({ "database": self._dbfile }, f)
+		self._config = Configuration(self._config_filename)
+		self._itemids = None
+
+	def _uuid(self):
+		return str(uuid.UUID(int = self._rng.getrandbits(128), version = 4))
+
+	def generate(self):
+		# Creates the synthetic database. History is generated with
+		# increasing timestamps and only decrements items that are on the
+		# list, so that the resulting shopping list is consistent with it.
+		for filename in [ self._dbfile, self._dbfile + "-wal", self._dbfile + "-shm" ]:
+			if os.path.exists(filename):
+				os.unlink(filename)
+
+		db = ShoppingListDB(self._dbfile, options = self._config.sqlite_options)
+		itemids = db.add_items("Item %d" % (i) for i in range(self._parameters["items"]))
+		self._itemids = list(itemids.values())
+		for i in range(self._parameters["aliases"]):
+			db.add_item_alias(self._rng.choice(self._itemids), "Alias %d" % (i))
+		for i in range(self._parameters["stores"]):
+			storeid = db.add_store("Store %d" % (i))
+			order = self._rng.sample(self._itemids, min(self._parameters["order_length"], len(self._itemids)))
+			db.set_store_order(storeid, { itemid: orderno for (orderno, itemid) in enumerate(order, 1) })
+		del db
+
+		counts = { }
+		history = [ ]
+		start = datetime.datetime.utcnow() - datetime.timedelta(days = self._parameters["history_days"])
+		step = datetime.timedelta(days = self._parameters["history_days"]) / max(self._parameters["history"], 1)
+		for i in range(self._parameters["history"]):
+			itemid = self._rng.choice(self._itemids)
+			if (counts.get(itemid, 0) > 0) and (self._rng.random() < 0.4):
+				delta = -1
+			else:
+				delta = 1
+			counts[itemid] = counts.get(itemid, 0) + delta
+			processed_utc = (start + i * step).strftime("%Y-%m-%dT%H:%M:%SZ")
+			history.append((self._uuid(), itemid, delta, "user%d" % (self._rng.randrange(self._parameters["users"])), processed_utc))
+
+		# Raw inserts, going through process_transaction() would take far
+		# too long for large histories.
+		db = sqlite3.connect(self._dbfile)
+		(changeno, ) = db.execute("SELECT value FROM properties WHERE key = 'changeno';").fetchone()
+		db.executemany("INSERT INTO history (transactionid, itemid, delta, user, processed_utc, changeno) VALUES (?, ?, ?, ?, ?, ?);", (entry + (changeno + 1, ) for entry in history))
+		db.executemany("INSERT INTO shopping_list (itemid, itemcount, last_edited_utc, changeno) VALUES (?, ?, ?, ?);", ((itemid, count, history[-1][4], changeno + 1) for (itemid, count) in counts.items()))
+		db.execute("UPDATE properties SET value = ? WHERE key = 'changeno';", (changeno + 1, ))
+		db.commit()
+		db.close()
+
+	@staticmethod
+	def _percentile(sorted_values, percentile):
+		index = min(len(sorted_values) - 1, max(0, round(percentile / 100 * len(sorted_values)) - 1))
+		return sorted_values[index]
+
+	@classmethod
+	def _summarize(cls, latencies, total_secs = None):
+		latencies = sorted(latencies)
+		if total_secs is None:
+			total_secs = sum(latencies)
+		return {
+			"iterations":			len(latencies),
+			"total_secs":			total_secs,
+			"throughput_per_sec":	len(latencies) / total_secs if (total_secs > 0) else None,
+			"latency_ms": {
+				"min":	1000 * latencies[0],
+				"mean":	1000 * sum(latencies) / len(latencies),
+				"p50":	1000 * cls._percentile(latencies, 50),
+				"p90":	1000 * cls._percentile(latencies, 90),
+				"p99":	1000 * cls._percentile(latencies, 99),
+				"max":	1000 * latencies[-1],
+			},
+		}
+
+	def _measure(self, function, iterations = None):
+		if iterations is None:
+			iterations = self._parameters["iterations"]
+		latencies = [ ]
+		for i in range(iterations):
+			t0 = time.perf_counter()
+			function()
+			latencies.append(time.perf_counter() - t0)
+		return self._summarize(latencies)
+
+	def _bench_get_all(self):
+		db = ShoppingListDB(self._dbfile, options = self._config.sqlite_options)
+		return self._measure(db.get_all)
+
+	def _bench_process_transaction(self):
+		db = ShoppingListDB(self._dbfile, options = self._config.sqlite_options)
+		return self._measure(lambda: db.process_transaction(self._uuid(), itemid = self._rng.choice(self._itemids), delta = 1, user = "bench"))
+
+	def _bench_process_transaction_concurrent(self):
+		processes = self._parameters["processes"]
+		jobs = [ (self._dbfile, self._config.sqlite_options, self._itemids, self._parameters["iterations"], self._parameters["seed"] * 1000 + i) for i in range(processes) ]
+		with multiprocessing.Pool(processes) as pool:
+			t0 = time.perf_counter()
+			latencies = pool.map(_concurrent_transaction_worker, jobs)
+			total_secs = time.perf_counter() - t0
+		return self._summarize([ latency for worker_latencies in latencies for latency in worker_latencies ], total_secs = total_secs)
+
+	def _bench_add_items(self):
+		db = ShoppingListDB(self._dbfile, options = self._config.sqlite_options)
+		names = [ "Item %d" % (i) for i in range(self._parameters["items"]) ]
+		return self._measure(lambda: db.add_items(names + [ "New item %s" % (self._uuid()) ]), iterations = max(1, self._parameters["iterations"] // 10))
+
+	def _bench_store_import(self):
+		# Equivalent to what "pyslist_cli.py import" does for one store
+		db = ShoppingListDB(self._dbfile, options = self._config.sqlite_options)
+		names = [ "Item %d" % (i) for i in self._rng.sample(range(self._parameters["items"]), min(self._parameters["order_length"], self._parameters["items"])) ]
+		def store_import():
+			storeid = db.add_store("Store 0")
+			itemids = db.add_items(names)
+			db.set_store_order(storeid, { itemids[name]: orderno for (orderno, name) in enumerate(names, 1) }, replace = True)
+		return self._measure(store_import, iterations = max(1, self._parameters["iterations"] // 10))
+
+	@staticmethod
+	def _cgi_environ(method, path, query = "", body = b""):
+		return {
+			"REQUEST_METHOD":	method,
+			"PATH_INFO":		path,
+			"QUERY_STRING":		query,
+			"REMOTE_USER":		"bench",
+			"CONTENT_LENGTH":	str(len(body)),
+		}
+
+	def _bench_api(self):
+		api_server = APIServer(self._config)
+		def api_call(method, path, query = "", body = b""):
+			response = api_server.handle(self._cgi_environ(method, path, query, body), io.BytesIO(body))
+			assert(response.status == "200 OK")
+
+		def api_transaction():
+			body = json.dumps({ "transactionid": self._uuid(), "itemid": self._rng.choice(self._itemids), "delta": 1 }).encode("utf-8")
+			api_call("POST", "/transaction", body = body)
+
+		def api_all_after_change():
+			api_transaction()
+			api_call("GET", "/all")
+
+		return {
+			"api_all_cached":			self._measure(lambda: api_call("GET", "/all")),
+			"api_all_after_change":		self._measure(api_all_after_change),
+			"api_changes":				self._measure(lambda: api_call("GET", "/changes", query = "since=1")),
+			"api_transaction":			self._measure(api_transaction),
+			"api_startup":				self._measure(lambda: APIServer(self._config), iterations = max(1, self._parameters["iterations"] // 10)),
+		}
+
+	def run(self):
+		t0 = time.perf_counter()
+		self.generate()
+		generation_secs = time.perf_counter() - t0
+
+		results = {
+			"get_all":							self._bench_get_all(),
+			"process_transaction":				self._bench_process_transaction(),
+			"process_transaction_concurrent":	self._bench_process_transaction_concurrent(),
+			"add_items":						self._bench_add_items(),
+			"store_import":						self._bench_store_import(),
+		}
+		results.update(self._bench_api())
+		return {
+			"parameters":		self._parameters,
+			"environment": {
+				"python":		sys.version.split()[0],
+				"sqlite":		sqlite3.sqlite_version,
+				"timestamp_utc":	datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+			},
+			"generation_secs":	generation_secs,
+			"database_bytes":	os.path.getsize(self._dbfile),
+			"results":			results,
+		}
+
+if __name__ == "__main__":
+	print(json.dumps(Benchmark(items = 200, history = 1000, iterations = 20).run(), indent = 4))
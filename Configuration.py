@@ -44,6 +44,80 @@ class Configuration():
 	def db_filename(self):
 		return self._path_replace(self._config["database"])
 
+	@property
+	def sqlite_options(self):
+		options = {
+			"journal_mode":		"wal",
+			"synchronous":		"normal",
+			"busy_timeout":		5000,
+			"cache_size":		-8192,
+			"mmap_size":		0,
+		}
+		options.update(self._config.get("sqlite", { }))
+		return options
+
+	@property
+	def compaction(self):
+		compaction = {
+			"retention_days":		180,
+			"archive":				None,
+			"auto_interval_hours":	None,
+		}
+		compaction.update(self._config.get("compaction", { }))
+		if compaction["archive"] is not None:
+			compaction["archive"] = self._path_replace(compaction["archive"])
+		return compaction
+
+	@property
+	def checkpoints(self):
+		# A checkpoint of the shopping list is taken after this many
+		# transactions or minutes, whichever comes first.
+		checkpoints = {
+			"transactions":	1000,
+			"minutes":		1440,
+		}
+		checkpoints.update(self._config.get("checkpoints", { }))
+		return checkpoints
+
+	@property
+	def lists(self):
+		lists = {
+			"directory":	"${INSTALL_DIR}/lists",
+			"users":		{ },
+			"pool_size":	8,
+		}
+		lists.update(self._config.get("lists", { }))
+		lists["directory"] = self._path_replace(lists["directory"])
+		return lists
+
+	@property
+	def snapshot_filename(self):
+		filename = self._config.get("snapshot")
+		if filename is None:
+			return None
+		return self._path_replace(filename)
+
+	@property
+	def write_queue(self):
+		# Group commit of write requests; only useful for a persistent
+		# server, disabled unless configured.
+		if self._config.get("write_queue") is None:
+			return None
+		write_queue = {
+			"delay_ms":		5,
+			"max_batch":	100,
+		}
+		write_queue.update(self._config["write_queue"])
+		return write_queue
+
+	@property
+	def slow_query_threshold(self):
+		# In seconds, None disables logging of slow queries
+		threshold_ms = self._config.get("slow_query_threshold_ms")
+		if threshold_ms is None:
+			return None
+		return threshold_ms / 1000
+
 	@property
 	def debug(self):
 		return self._config.get("debug", False)
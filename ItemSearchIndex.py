@@ -0,0 +1,93 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import bisect
+import unicodedata
+
+class ItemSearchIndex():
+	def __init__(self, names, frequencies = None):
+		# names is an iterable of (itemid, item name, matched name) tuples;
+		# for the main description of an item, item name and matched name are
+		# identical, for aliases the matched name is the alias.
+		self._frequencies = frequencies if (frequencies is not None) else { }
+		self._entries = [ ]
+		self._keys = [ ]
+		for (itemid, item_name, matched_name) in names:
+			normalized = self.normalize(matched_name)
+			entryno = len(self._entries)
+			self._entries.append((itemid, item_name, matched_name, normalized))
+
+			# Every word of the name is indexed so that prefix searches also
+			# find "Vollkorn Müsli" when searching for "musli".
+			self._keys.append((normalized, entryno, 0))
+			for (index, char) in enumerate(normalized):
+				if (index > 0) and (normalized[index - 1] == " ") and (char != " "):
+					self._keys.append((normalized[index : ], entryno, 1))
+		self._keys.sort()
+
+	@staticmethod
+	def normalize(text):
+		# Case and diacritic insensitive form of a name, i.e., "Müsli" and
+		# "MUSLI" both become "musli". Whitespace is collapsed.
+		text = unicodedata.normalize("NFKD", text)
+		text = "".join(char for char in text if not unicodedata.combining(char))
+		return " ".join(text.casefold().split())
+
+	def _prefix_matches(self, term):
+		index = bisect.bisect_left(self._keys, (term, ))
+		while (index < len(self._keys)) and self._keys[index][0].startswith(term):
+			(key, entryno, quality) = self._keys[index]
+			yield (entryno, quality)
+			index += 1
+
+	def _substring_matches(self, term):
+		for (entryno, entry) in enumerate(self._entries):
+			if term in entry[3]:
+				yield (entryno, 2)
+
+	def search(self, term, limit = 10):
+		# Returns a list of (itemid, item name, matched name) tuples. Matches
+		# at the beginning of the name rank before matches at the beginning of
+		# a word, which rank before any other substring matches. Within each
+		# class, more frequently purchased items come first.
+		term = self.normalize(term)
+		if term == "":
+			return [ ]
+
+		best_match = { }
+		for (entryno, quality) in self._prefix_matches(term):
+			itemid = self._entries[entryno][0]
+			if (itemid not in best_match) or (quality < best_match[itemid][0]):
+				best_match[itemid] = (quality, entryno)
+		if len(best_match) < limit:
+			for (entryno, quality) in self._substring_matches(term):
+				itemid = self._entries[entryno][0]
+				if itemid not in best_match:
+					best_match[itemid] = (quality, entryno)
+
+		ranked = sorted(best_match.items(), key = lambda match: (match[1][0], -self._frequencies.get(match[0], 0), self._entries[match[1][1]][3]))
+		return [ self._entries[entryno][ : 3] for (itemid, (quality, entryno)) in ranked[ : limit] ]
+
+if __name__ == "__main__":
+	index = ItemSearchIndex([ (1, "Müsli", "Müsli"), (2, "Schokomüsli", "Schokomüsli"), (3, "Milch", "Milch"), (4, "Vollkorn Müsli", "Vollkorn Müsli"), (3, "Milch", "Kuhmilch") ], frequencies = { 4: 10 })
+	print(index.search("musli"))
+	print(index.search("MILCH"))
@@ -0,0 +1,55 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import collections
+
+class ListPool():
+	"""Keeps the most recently used per-list contexts (database connections
+	and caches) open, up to a given number. Evicted contexts are not closed
+	explicitly: responses that are still being streamed may hold a reference
+	and the connections are closed once the last reference is gone. Other
+	resources can be released through the close_context callback."""
+
+	def __init__(self, open_context, capacity = 8, close_context = None):
+		self._open_context = open_context
+		self._capacity = capacity
+		self._close_context = close_context
+		self._contexts = collections.OrderedDict()
+
+	def __len__(self):
+		return len(self._contexts)
+
+	def __contains__(self, listid):
+		return listid in self._contexts
+
+	def get(self, listid):
+		context = self._contexts.get(listid)
+		if context is None:
+			context = self._open_context(listid)
+			self._contexts[listid] = context
+			while len(self._contexts) > self._capacity:
+				(evicted_listid, evicted_context) = self._contexts.popitem(last = False)
+				if self._close_context is not None:
+					self._close_context(evicted_context)
+		else:
+			self._contexts.move_to_end(listid)
+		return context
@@ -0,0 +1,198 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import json
+import time
+import uuid
+import random
+import threading
+import collections
+import concurrent.futures
+import requests
+
+class LoadGenerator():
+	"""Issues a mix of API calls against a remote pyslist installation from
+	multiple threads and collects latency statistics. Every worker thread
+	keeps its own HTTP session, so connections are reused and digest
+	authentication is only negotiated once per worker."""
+
+	_OPERATIONS = [ "all", "transaction", "item" ]
+	_HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+	def __init__(self, base_uri, username, password, mix = None, concurrency = 4, rate = None, itemid = 10, replay = 0.1, seed = None):
+		self._base_uri = base_uri
+		self._username = username
+		self._password = password
+		self._mix = mix if (mix is not None) else { "all": 10, "transaction": 5, "item": 1 }
+		for operation in self._mix:
+			if operation not in self._OPERATIONS:
+				raise ValueError("Unsupported operation '%s' in mix, must be one of %s." % (operation, ", ".join(self._OPERATIONS)))
+		self._concurrency = concurrency
+		self._rate = rate
+		self._itemid = itemid
+		self._replay = replay
+		self._seed = seed
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._next_requestno = 0
+		self._applied_transactions = collections.deque(maxlen = 1000)
+		self._results = collections.defaultdict(lambda: { "latencies": [ ], "errors": 0 })
+		self._idempotency_violations = 0
+
+	@staticmethod
+	def parse_mix(text):
+		# "all=10,transaction=5,item=1" -> { "all": 10, "transaction": 5, "item": 1 }
+		mix = { }
+		for entry in text.split(","):
+			(operation, weight) = entry.split("=")
+			mix[operation.strip()] = int(weight)
+		return mix
+
+	def _worker_state(self, workerno):
+		if not hasattr(self._local, "session"):
+			self._local.session = requests.Session()
+			self._local.session.auth = requests.auth.HTTPDigestAuth(self._username, self._password)
+			self._local.random = random.Random(None if (self._seed is None) else self._seed + workerno)
+			self._local.on_list = False
+		return self._local
+
+	def _claim_request(self, request_count, start_time):
+		# Returns False once all requests have been claimed. With a rate
+		# given, requests are spread evenly over time across all workers.
+		with self._lock:
+			requestno = self._next_requestno
+			if requestno >= request_count:
+				return False
+			self._next_requestno += 1
+		if self._rate is not None:
+			delay = start_time + (requestno / self._rate) - time.perf_counter()
+			if delay > 0:
+				time.sleep(delay)
+		return True
+
+	def _post(self, state, endpoint, data):
+		return state.session.post(self._base_uri + endpoint, data = json.dumps(data).encode())
+
+	def _execute(self, state, operation):
+		# Returns the name under which the call is accounted and whether it
+		# succeeded.
+		if operation == "all":
+			response = state.session.get(self._base_uri + "/all")
+			return ("all", (response.status_code == 200) and response.json()["success"])
+		elif operation == "item":
+			response = self._post(state, "/item", { "name": "loadtest-%s" % (uuid.uuid4()) })
+			return ("item", (response.status_code == 200) and response.json()["success"])
+
+		with self._lock:
+			replayed = self._applied_transactions[state.random.randrange(len(self._applied_transactions))] if ((len(self._applied_transactions) > 0) and (state.random.random() < self._replay)) else None
+		if replayed is not None:
+			# Resubmitting a transaction that was already applied must not
+			# have any effect.
+			response = self._post(state, "/transaction", replayed)
+			success = (response.status_code == 200) and response.json()["success"]
+			if success and (response.json()["status"] != "duplicate"):
+				with self._lock:
+					self._idempotency_violations += 1
+			return ("transaction_replay", success)
+
+		# Every worker alternately adds and removes the item so that the
+		# item count never becomes negative and the list does not grow.
+		transaction = {
+			"transactionid":	str(uuid.uuid4()),
+			"itemid":			self._itemid,
+			"delta":			-1 if state.on_list else 1,
+		}
+		response = self._post(state, "/transaction", transaction)
+		success = (response.status_code == 200) and response.json()["success"]
+		if success and (response.json()["status"] == "applied"):
+			state.on_list = not state.on_list
+			with self._lock:
+				self._applied_transactions.append(transaction)
+		return ("transaction", success)
+
+	def _worker(self, workerno, request_count, start_time):
+		state = self._worker_state(workerno)
+		operations = list(self._mix.keys())
+		weights = list(self._mix.values())
+		while self._claim_request(request_count, start_time):
+			operation = state.random.choices(operations, weights = weights)[0]
+			t0 = time.perf_counter()
+			try:
+				(name, success) = self._execute(state, operation)
+			except (requests.exceptions.RequestException, ValueError, KeyError):
+				(name, success) = (operation, False)
+			latency = time.perf_counter() - t0
+			with self._lock:
+				self._results[name]["latencies"].append(latency)
+				if not success:
+					self._results[name]["errors"] += 1
+
+	@classmethod
+	def _summarize(cls, latencies, errors, total_secs):
+		latencies = sorted(latencies)
+		histogram = collections.OrderedDict((bucket, 0) for bucket in cls._HISTOGRAM_BUCKETS_MS)
+		histogram["+Inf"] = 0
+		for latency in latencies:
+			latency_ms = 1000 * latency
+			for bucket in histogram:
+				if (bucket == "+Inf") or (latency_ms <= bucket):
+					histogram[bucket] += 1
+					break
+		def percentile(p):
+			return 1000 * latencies[min(len(latencies) - 1, (len(latencies) * p) // 100)]
+		return {
+			"requests":				len(latencies),
+			"errors":				errors,
+			"throughput_per_sec":	len(latencies) / total_secs,
+			"latency_ms": {
+				"min":	1000 * latencies[0],
+				"mean":	1000 * sum(latencies) / len(latencies),
+				"p50":	percentile(50),
+				"p90":	percentile(90),
+				"p99":	percentile(99),
+				"max":	1000 * latencies[-1],
+			},
+			"histogram_ms":			[ [ bucket, count ] for (bucket, count) in histogram.items() ],
+		}
+
+	def run(self, request_count):
+		start_time = time.perf_counter()
+		with concurrent.futures.ThreadPoolExecutor(max_workers = self._concurrency) as executor:
+			futures = [ executor.submit(self._worker, workerno, request_count, start_time) for workerno in range(self._concurrency) ]
+			for future in futures:
+				future.result()
+		total_secs = time.perf_counter() - start_time
+
+		all_latencies = [ latency for result in self._results.values() for latency in result["latencies"] ]
+		return {
+			"parameters": {
+				"requests":		request_count,
+				"concurrency":	self._concurrency,
+				"rate":			self._rate,
+				"mix":			self._mix,
+				"replay":		self._replay,
+			},
+			"total_secs":				total_secs,
+			"idempotency_violations":	self._idempotency_violations,
+			"total":					self._summarize(all_latencies, sum(result["errors"] for result in self._results.values()), total_secs),
+			"operations":				{ name: self._summarize(result["latencies"], result["errors"], total_secs) for (name, result) in sorted(self._results.items()) },
+		}
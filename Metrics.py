@@ -0,0 +1,163 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import sys
+import time
+import sqlite3
+import threading
+
+class Metrics():
+	# Collects counters and histograms and renders them in the Prometheus
+	# text exposition format.
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counters = { }
+		self._histograms = { }
+		self._help = { }
+
+	def describe(self, name, help_text):
+		self._help[name] = help_text
+
+	@staticmethod
+	def _label_key(labels):
+		return tuple(sorted(labels.items())) if (labels is not None) else ()
+
+	def increment(self, name, labels = None, value = 1):
+		key = self._label_key(labels)
+		with self._lock:
+			series = self._counters.setdefault(name, { })
+			series[key] = series.get(key, 0) + value
+
+	def observe(self, name, value, labels = None, buckets = None):
+		# Without buckets, only count and sum of the observations are kept.
+		key = self._label_key(labels)
+		with self._lock:
+			(bucket_bounds, series) = self._histograms.setdefault(name, (tuple(buckets or ()), { }))
+			histogram = series.get(key)
+			if histogram is None:
+				histogram = { "count": 0, "sum": 0, "buckets": [ 0 ] * len(bucket_bounds) }
+				series[key] = histogram
+			histogram["count"] += 1
+			histogram["sum"] += value
+			for (index, bound) in enumerate(bucket_bounds):
+				if value <= bound:
+					histogram["buckets"][index] += 1
+
+	@staticmethod
+	def _format_labels(key, extra = None):
+		labels = list(key) + (extra or [ ])
+		if len(labels) == 0:
+			return ""
+		escaped = [ (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for (name, value) in labels ]
+		return "{%s}" % (",".join("%s=\"%s\"" % (name, value) for (name, value) in escaped))
+
+	def render(self):
+		lines = [ ]
+		with self._lock:
+			for (name, series) in sorted(self._counters.items()):
+				if name in self._help:
+					lines.append("# HELP %s %s" % (name, self._help[name]))
+				lines.append("# TYPE %s counter" % (name))
+				for (key, value) in sorted(series.items()):
+					lines.append("%s%s %s" % (name, self._format_labels(key), value))
+			for (name, (bucket_bounds, series)) in sorted(self._histograms.items()):
+				if name in self._help:
+					lines.append("# HELP %s %s" % (name, self._help[name]))
+				lines.append("# TYPE %s %s" % (name, "histogram" if (len(bucket_bounds) > 0) else "summary"))
+				for (key, histogram) in sorted(series.items()):
+					for (bound, count) in zip(bucket_bounds, histogram["buckets"]):
+						lines.append("%s_bucket%s %d" % (name, self._format_labels(key, [ ("le", bound) ]), count))
+					if len(bucket_bounds) > 0:
+						lines.append("%s_bucket%s %d" % (name, self._format_labels(key, [ ("le", "+Inf") ]), histogram["count"]))
+					lines.append("%s_sum%s %s" % (name, self._format_labels(key), histogram["sum"]))
+					lines.append("%s_count%s %d" % (name, self._format_labels(key), histogram["count"]))
+		return "\n".join(lines) + "\n"
+
+class InstrumentedCursor():
+	# Wraps a sqlite3 cursor and records execution time and number of rows
+	# for every statement. Statements taking longer than the slow query
+	# threshold are logged to stderr.
+	def __init__(self, cursor, metrics, slow_query_threshold = None):
+		self._cursor = cursor
+		self._metrics = metrics
+		self._slow_query_threshold = slow_query_threshold
+		self._statement = None
+
+	@staticmethod
+	def _statement_label(sql):
+		sql = " ".join(sql.split())
+		if len(sql) > 120:
+			sql = sql[ : 117] + "..."
+		return sql
+
+	def _record(self, sql, parameters, t0):
+		duration = time.perf_counter() - t0
+		self._statement = self._statement_label(sql)
+		self._metrics.observe("pyslist_sql_statement_seconds", duration, labels = { "statement": self._statement })
+		if self._statement.upper().startswith("BEGIN"):
+			self._metrics.observe("pyslist_sql_lock_wait_seconds", duration, buckets = (0.001, 0.01, 0.1, 0.5, 1, 5))
+		if (self._cursor.rowcount is not None) and (self._cursor.rowcount > 0):
+			self._metrics.increment("pyslist_sql_statement_rows_total", labels = { "statement": self._statement }, value = self._cursor.rowcount)
+		if (self._slow_query_threshold is not None) and (duration >= self._slow_query_threshold):
+			print("pyslist: slow query (%.1f ms): %s %s" % (duration * 1000, self._statement, str(parameters)[ : 200]), file = sys.stderr)
+
+	def _run(self, method, sql, parameters):
+		t0 = time.perf_counter()
+		try:
+			method(sql, parameters)
+		except sqlite3.OperationalError as e:
+			if "locked" in str(e):
+				self._metrics.increment("pyslist_sql_lock_errors_total")
+			raise
+		finally:
+			self._record(sql, parameters if (method == self._cursor.execute) else None, t0)
+		return self
+
+	def execute(self, sql, parameters = ()):
+		return self._run(self._cursor.execute, sql, parameters)
+
+	def executemany(self, sql, parameters):
+		return self._run(self._cursor.executemany, sql, parameters)
+
+	def _count_rows(self, count):
+		if (self._statement is not None) and (count > 0):
+			self._metrics.increment("pyslist_sql_statement_rows_total", labels = { "statement": self._statement }, value = count)
+
+	def fetchone(self):
+		row = self._cursor.fetchone()
+		self._count_rows(0 if (row is None) else 1)
+		return row
+
+	def fetchall(self):
+		rows = self._cursor.fetchall()
+		self._count_rows(len(rows))
+		return rows
+
+	def __iter__(self):
+		count = 0
+		for row in self._cursor:
+			count += 1
+			yield row
+		self._count_rows(count)
+
+	def __getattr__(self, name):
+		return getattr(self._cursor, name)
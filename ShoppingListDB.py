@@ -22,173 +22,1084 @@
 import sqlite3
 import contextlib
 import datetime
+import urllib.parse
+from Metrics import InstrumentedCursor
+from ItemSearchIndex import ItemSearchIndex
 
 class OperationalException(Exception): pass
 
 class ShoppingListDB():
-	def __init__(self, sqlite_dbfile):
-		self._db = sqlite3.connect(sqlite_dbfile)
-		self._cursor = self._db.cursor()
-
-		with contextlib.suppress(sqlite3.OperationalError):
-			self._cursor.execute("""
-			CREATE TABLE items (
-				itemid integer PRIMARY KEY AUTOINCREMENT,
-				description varchar NOT NULL UNIQUE
-			);
-			""")
-
-		with contextlib.suppress(sqlite3.OperationalError):
-			self._cursor.execute("""
-			CREATE TABLE item_alias_names (
-				description varchar PRIMARY KEY,
-				itemid integer NOT NULL,
-				FOREIGN KEY(itemid) REFERENCES items(itemid)
-			);
-			""")
-
-		with contextlib.suppress(sqlite3.OperationalError):
-			self._cursor.execute("""
-			CREATE TABLE shopping_list (
-				itemid integer PRIMARY KEY,
-				itemcount integer NOT NULL DEFAULT 0,
-				last_edited_utc timestamp NOT NULL,
-				CHECK(itemcount >= 0),
-				FOREIGN KEY(itemid) REFERENCES items(itemid)
-			);
-			""")
-
-		with contextlib.suppress(sqlite3.OperationalError):
-			self._cursor.execute("""
-			CREATE TABLE stores (
-				storeid integer PRIMARY KEY AUTOINCREMENT,
-				storename varchar NOT NULL UNIQUE
-			);
-			""")
-
-		with contextlib.suppress(sqlite3.OperationalError):
-			self._cursor.execute("""
-			CREATE TABLE storeitemorder (
-				storeid integer NOT NULL,
-				itemid integer NOT NULL,
-				orderno integer NOT NULL,
-				PRIMARY KEY(storeid, itemid),
-				FOREIGN KEY(storeid) REFERENCES stores(storeid),
-				FOREIGN KEY(itemid) REFERENCES items(itemid)
-			);
-			""")
-
-		with contextlib.suppress(sqlite3.OperationalError):
-			self._cursor.execute("""
-			CREATE TABLE history (
-				transactionid uuid NOT NULL PRIMARY KEY,
-				itemid integer NOT NULL,
-				delta integer NOT NULL,
-				user varchar NOT NULL,
-				processed_utc timestamp NOT NULL,
-				CHECK(delta != 0),
-				FOREIGN KEY(itemid) REFERENCES items(itemid)
-			);
-			""")
+	def __init__(self, sqlite_dbfile, options = None, metrics = None, slow_query_threshold = None, checkpoint_transactions = 1000, checkpoint_minutes = 1440):
+		self._sqlite_dbfile = sqlite_dbfile
+		self._options = options if (options is not None) else { }
+		self._metrics = metrics
+		self._slow_query_threshold = slow_query_threshold
+		self._checkpoint_transactions = checkpoint_transactions
+		self._checkpoint_minutes = checkpoint_minutes
+		self._db = self._connect(self._sqlite_dbfile)
+		self._cursor = self._create_cursor(self._db)
+		if "journal_mode" in self._options:
+			self._cursor.execute("PRAGMA journal_mode = %s;" % (self._options["journal_mode"]))
+		if "synchronous" in self._options:
+			self._cursor.execute("PRAGMA synchronous = %s;" % (self._options["synchronous"]))
+		self._migrate()
+		self._read_db = None
+		self._change_listeners = [ ]
+		self._pending_changeno = None
+
+	def _connect(self, database, read_only = False):
+		# Connections may be used from different threads of a persistent
+		# server; the caller is responsible for serializing access.
+		if read_only:
+			db = sqlite3.connect("file:%s?mode=ro" % (urllib.parse.quote(database)), uri = True, check_same_thread = False)
+		else:
+			db = sqlite3.connect(database, check_same_thread = False)
+		for pragma in [ "busy_timeout", "cache_size", "mmap_size" ]:
+			if pragma in self._options:
+				db.execute("PRAGMA %s = %d;" % (pragma, self._options[pragma]))
+		return db
+
+	def _create_cursor(self, db):
+		cursor = db.cursor()
+		if self._metrics is not None:
+			cursor = InstrumentedCursor(cursor, self._metrics, slow_query_threshold = self._slow_query_threshold)
+		return cursor
+
+	@property
+	def _read_cursor(self):
+		# Reads are performed through a separate read-only connection (opened
+		# on first use) so that, in WAL mode, they never wait for a writer.
+		# In-memory databases cannot be shared between connections.
+		if self._read_db is None:
+			if self._sqlite_dbfile == ":memory:":
+				self._read_db = self._db
+			else:
+				self._read_db = self._connect(self._sqlite_dbfile, read_only = True)
+			self._read_db_cursor = self._create_cursor(self._read_db)
+		return self._read_db_cursor
+
+	@contextlib.contextmanager
+	def _read_snapshot(self):
+		# Groups multiple reads into one transaction so that they all see
+		# the same consistent state of the database.
+		cursor = self._read_cursor
+		if self._read_db is self._db:
+			yield
+		else:
+			cursor.execute("BEGIN;")
+			try:
+				yield
+			finally:
+				self._read_db.rollback()
+
+	def _migration_initial_schema(self):
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS items (
+			itemid integer PRIMARY KEY AUTOINCREMENT,
+			description varchar NOT NULL UNIQUE
+		);
+		""")
+
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS item_alias_names (
+			description varchar PRIMARY KEY,
+			itemid integer NOT NULL,
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS shopping_list (
+			itemid integer PRIMARY KEY,
+			itemcount integer NOT NULL DEFAULT 0,
+			last_edited_utc timestamp NOT NULL,
+			CHECK(itemcount >= 0),
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS stores (
+			storeid integer PRIMARY KEY AUTOINCREMENT,
+			storename varchar NOT NULL UNIQUE
+		);
+		""")
+
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS storeitemorder (
+			storeid integer NOT NULL,
+			itemid integer NOT NULL,
+			orderno integer NOT NULL,
+			PRIMARY KEY(storeid, itemid),
+			FOREIGN KEY(storeid) REFERENCES stores(storeid),
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS history (
+			transactionid uuid NOT NULL PRIMARY KEY,
+			itemid integer NOT NULL,
+			delta integer NOT NULL,
+			user varchar NOT NULL,
+			processed_utc timestamp NOT NULL,
+			CHECK(delta != 0),
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+
+	def _get_column_names(self, table_name):
+		return set(row[1] for row in self._cursor.execute("PRAGMA table_info(%s);" % (table_name)).fetchall())
+
+	def _migration_change_numbers(self):
+		# Databases which were used before the migration subsystem existed
+		# may already contain these columns.
+		for table_name in [ "items", "item_alias_names", "shopping_list", "stores", "history" ]:
+			if "changeno" not in self._get_column_names(table_name):
+				self._cursor.execute("ALTER TABLE %s ADD COLUMN changeno integer NOT NULL DEFAULT 0;" % (table_name))
+
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS properties (
+			key varchar PRIMARY KEY,
+			value NOT NULL
+		);
+		""")
+
+	def _migration_indices(self):
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS history_itemid_idx ON history(itemid);")
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS history_processed_utc_idx ON history(processed_utc);")
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS storeitemorder_itemid_idx ON storeitemorder(itemid);")
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS item_alias_names_itemid_idx ON item_alias_names(itemid);")
+		for table_name in [ "items", "item_alias_names", "shopping_list", "stores" ]:
+			self._cursor.execute("CREATE INDEX IF NOT EXISTS %s_changeno_idx ON %s(changeno);" % (table_name, table_name))
+
+	def _migration_history_aggregates(self):
+		# Daily per-item and per-user totals of history entries that were
+		# removed from the history table by compaction.
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS history_daily (
+			day varchar NOT NULL,
+			itemid integer NOT NULL,
+			user varchar NOT NULL,
+			added integer NOT NULL,
+			removed integer NOT NULL,
+			additions integer NOT NULL,
+			removals integer NOT NULL,
+			PRIMARY KEY(day, itemid, user),
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+
+	def _migration_purchase_statistics(self):
+		# Derived from the history by refresh_statistics(): the distinct days
+		# on which an item was added to the list, per-item aggregates of
+		# these and the number of days on which two items were added together.
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS history_changeno_idx ON history(changeno);")
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS item_purchase_days (
+			day varchar NOT NULL,
+			itemid integer NOT NULL,
+			PRIMARY KEY(day, itemid),
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS item_statistics (
+			itemid integer PRIMARY KEY,
+			purchase_days integer NOT NULL,
+			first_day varchar NOT NULL,
+			last_day varchar NOT NULL,
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS item_cooccurrence (
+			itemid1 integer NOT NULL,
+			itemid2 integer NOT NULL,
+			days integer NOT NULL,
+			PRIMARY KEY(itemid1, itemid2),
+			CHECK(itemid1 < itemid2),
+			FOREIGN KEY(itemid1) REFERENCES items(itemid),
+			FOREIGN KEY(itemid2) REFERENCES items(itemid)
+		);
+		""")
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS item_cooccurrence_itemid2_idx ON item_cooccurrence(itemid2);")
+
+	def _migration_store_order_index(self):
+		# Items of a store in shelf order, used for sorting the shopping list
+		# by store and for retrieving store orders without a sort step.
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS storeitemorder_storeid_orderno_idx ON storeitemorder(storeid, orderno, itemid);")
+
+	def _migration_item_lookup(self):
+		# Normalized names (see ItemSearchIndex.normalize()) of all items and
+		# aliases, used for resolving item names in transactions. The table
+		# is maintained by _add_item_lookups() whenever items or aliases are
+		# added.
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS item_lookup (
+			normalized varchar NOT NULL,
+			is_alias boolean NOT NULL,
+			description varchar NOT NULL,
+			itemid integer NOT NULL,
+			PRIMARY KEY(normalized, is_alias, description),
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+		for (table_name, is_alias) in [ ("items", 0), ("item_alias_names", 1) ]:
+			self._add_item_lookups(is_alias, self._cursor.execute("SELECT description, itemid FROM %s;" % (table_name)).fetchall())
+
+	def _migration_checkpoints(self):
+		# Copies of the shopping list as it was after all history entries up
+		# to and including (created_utc, changeno) of the checkpoint, in the
+		# order of (processed_utc, changeno), had been applied. History of
+		# databases older than the change numbers has changeno 0, therefore
+		# the processing time comes first. Existing databases start with a
+		# checkpoint of their current state, their history may already have
+		# been compacted.
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS checkpoints (
+			checkpointid integer PRIMARY KEY AUTOINCREMENT,
+			created_utc timestamp NOT NULL,
+			changeno integer NOT NULL
+		);
+		""")
+		self._cursor.execute("""
+		CREATE TABLE IF NOT EXISTS checkpoint_items (
+			checkpointid integer NOT NULL,
+			itemid integer NOT NULL,
+			itemcount integer NOT NULL,
+			PRIMARY KEY(checkpointid, itemid),
+			FOREIGN KEY(checkpointid) REFERENCES checkpoints(checkpointid),
+			FOREIGN KEY(itemid) REFERENCES items(itemid)
+		);
+		""")
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS checkpoints_created_utc_changeno_idx ON checkpoints(created_utc, changeno);")
+		if self._cursor.execute("SELECT EXISTS (SELECT 1 FROM history) OR EXISTS (SELECT 1 FROM history_daily);").fetchone()[0]:
+			changeno = self._cursor.execute("SELECT value FROM properties WHERE key = 'changeno';").fetchone()
+			self._create_checkpoint(datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), changeno[0] if (changeno is not None) else 0)
+
+	def _migration_drop_item_lookup_triggers(self):
+		# item_lookup was previously maintained by triggers that called a
+		# Python function, which prevented connections without it (e.g., the
+		# sqlite3 shell) from adding or renaming items and aliases.
+		for table_name in [ "items", "item_alias_names" ]:
+			for event in [ "insert", "update", "delete" ]:
+				self._cursor.execute("DROP TRIGGER IF EXISTS %s_lookup_%s;" % (table_name, event))
+
+	# Schema migrations in the order they need to be applied. The schema
+	# version stored in the database (PRAGMA user_version) is the number of
+	# migrations that have already been applied. Only append to this list.
+	_MIGRATIONS = [
+		_migration_initial_schema,
+		_migration_change_numbers,
+		_migration_indices,
+		_migration_history_aggregates,
+		_migration_purchase_statistics,
+		_migration_store_order_index,
+		_migration_item_lookup,
+		_migration_checkpoints,
+		_migration_drop_item_lookup_triggers,
+	]
+
+	def _get_schema_version(self):
+		return self._cursor.execute("PRAGMA user_version;").fetchone()[0]
+
+	def _migrate(self):
+		if self._get_schema_version() == len(self._MIGRATIONS):
+			# Fast path: schema is up to date.
+			return
+
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		try:
+			# Another process may have migrated while we were waiting for the
+			# write lock, therefore check again.
+			schema_version = self._get_schema_version()
+			if schema_version > len(self._MIGRATIONS):
+				raise OperationalException("Database schema version %d is newer than the most recent version %d supported by this version of pyslist." % (schema_version, len(self._MIGRATIONS)))
+			for (version, migration) in enumerate(self._MIGRATIONS[schema_version : ], schema_version + 1):
+				migration(self)
+				self._cursor.execute("PRAGMA user_version = %d;" % (version))
+			self._db.commit()
+		except Exception:
+			self._db.rollback()
+			raise
+
+	def get_changeno(self):
+		# The change number is a counter that is incremented by every
+		# operation which modifies the database contents. Modified rows are
+		# tagged with the change number so that clients can retrieve all
+		# changes that occurred after a given point in time.
+		changeno = self._read_cursor.execute("SELECT value FROM properties WHERE key = 'changeno';").fetchone()
+		if changeno is None:
+			return 0
+		else:
+			return changeno[0]
+
+	def _next_changeno(self):
+		self._cursor.execute("INSERT INTO properties (key, value) VALUES ('changeno', 1) ON CONFLICT(key) DO UPDATE SET value = value + 1;")
+		self._pending_changeno = self._cursor.execute("SELECT value FROM properties WHERE key = 'changeno';").fetchone()[0]
+		return self._pending_changeno
+
+	def add_change_listener(self, callback):
+		# The callback is invoked with the new change number after every
+		# committed modification of the database contents.
+		self._change_listeners.append(callback)
+
+	def _commit(self):
+		self._db.commit()
+		(changeno, self._pending_changeno) = (self._pending_changeno, None)
+		if changeno is not None:
+			for callback in self._change_listeners:
+				callback(changeno)
+
+	def _rollback(self):
+		self._db.rollback()
+		self._pending_changeno = None
 
 	def get_shopping_list(self):
-		return { itemid: itemcount for (itemid, itemcount) in self._cursor.execute("SELECT itemid, itemcount FROM shopping_list WHERE itemcount > 0;").fetchall() }
+		return { itemid: itemcount for (itemid, itemcount) in self._read_cursor.execute("SELECT itemid, itemcount FROM shopping_list WHERE itemcount > 0;").fetchall() }
 
 	def get_item_list(self):
-		return { itemid: description for (itemid, description) in self._cursor.execute("SELECT itemid, description FROM items;").fetchall() }
+		return { itemid: description for (itemid, description) in self._read_cursor.execute("SELECT itemid, description FROM items;").fetchall() }
 
 	def get_item_aliases(self):
-		return { description: itemid for (description, itemid) in self._cursor.execute("SELECT description, itemid FROM item_alias_names;").fetchall() }
+		return { description: itemid for (description, itemid) in self._read_cursor.execute("SELECT description, itemid FROM item_alias_names;").fetchall() }
+
+	def get_catalog_changeno(self):
+		# Most recent change number of any item or alias
+		return self._read_cursor.execute("SELECT MAX((SELECT IFNULL(MAX(changeno), 0) FROM items), (SELECT IFNULL(MAX(changeno), 0) FROM item_alias_names));").fetchone()[0]
 
-	def _get_store_list(self):
-		return { storeid: storename for (storeid, storename) in self._cursor.execute("SELECT storeid, storename FROM stores;").fetchall() }
+	def get_item_names(self):
+		# Returns (itemid, item name, name) tuples for all item descriptions
+		# and aliases.
+		return self._read_cursor.execute("""
+			SELECT itemid, description, description FROM items
+			UNION ALL
+			SELECT items.itemid, items.description, item_alias_names.description FROM item_alias_names JOIN items ON items.itemid = item_alias_names.itemid;
+		""").fetchall()
 
-	def _get_store_order(self, storeid):
-		return { itemid: orderno for (itemid, orderno) in self._cursor.execute("SELECT itemid, orderno FROM storeitemorder WHERE storeid = ?;", (storeid, )).fetchall() }
+	def get_purchase_frequencies(self):
+		# Number of days on which each item was added to the list, as of the
+		# last refresh_statistics().
+		return { itemid: purchase_days for (itemid, purchase_days) in self._read_cursor.execute("SELECT itemid, purchase_days FROM item_statistics;").fetchall() }
 
-	def get_stores(self):
+	def get_stores(self, since = None, compact = False):
+		# All stores (or those changed after the given change number) and
+		# their item orders are retrieved in one joined query. In compact
+		# representation, each store's order is a list of item IDs in shelf
+		# order instead of an {itemid: orderno} dictionary; items that have no
+		# position within the store (negative orderno) are omitted from it.
+		# Stores of databases older than the change numbers have changeno 0,
+		# therefore a full read does not filter by change number at all.
+		if since is None:
+			rows = self._read_cursor.execute("SELECT stores.storeid, storename, itemid, orderno FROM stores LEFT JOIN storeitemorder ON stores.storeid = storeitemorder.storeid ORDER BY stores.storeid, orderno, itemid;")
+		else:
+			rows = self._read_cursor.execute("SELECT stores.storeid, storename, itemid, orderno FROM stores LEFT JOIN storeitemorder ON stores.storeid = storeitemorder.storeid WHERE stores.changeno > ? ORDER BY stores.storeid, orderno, itemid;", (since, ))
 		stores = { }
-		for (storeid, storename) in self._get_store_list().items():
-			store = {
-				"storeid": storeid,
-				"order": self._get_store_order(storeid),
-			}
-			stores[storename] = store
+		for (storeid, storename, itemid, orderno) in rows:
+			store = stores.get(storename)
+			if store is None:
+				store = {
+					"storeid": storeid,
+					"order": [ ] if compact else { },
+				}
+				stores[storename] = store
+			if itemid is None:
+				continue
+			if not compact:
+				store["order"][itemid] = orderno
+			elif orderno >= 0:
+				store["order"].append(itemid)
 		return stores
 
-	def get_all(self):
-		return {
-			"shopping_list":	self.get_shopping_list(),
-			"items":			self.get_item_list(),
-			"item_aliases":		self.get_item_aliases(),
-			"stores":			self.get_stores(),
-		}
+	# Sections of a shopping list sorted by store: items with a position in
+	# the store, items listed in the store's section of unordered items
+	# (after the "=" marker in the import file) and items not known to the
+	# store at all.
+	_STORE_SECTIONS = [ "ordered", "unordered", "unknown" ]
+
+	def get_sorted_shopping_list(self, storename = None):
+		# Returns the change number and the shopping list entries as
+		# (itemid, item name, count, section) tuples in the order of the given
+		# store; within a section (and without a store), entries are sorted by
+		# name.
+		with self._read_snapshot():
+			if storename is None:
+				storeid = None
+			else:
+				storeid = self._read_cursor.execute("SELECT storeid FROM stores WHERE storename = ?;", (storename, )).fetchone()
+				if storeid is None:
+					raise OperationalException("No such store: %s" % (storename))
+				storeid = storeid[0]
+			entries = self._read_cursor.execute("""
+				SELECT shopping_list.itemid, items.description, shopping_list.itemcount,
+					CASE WHEN storeitemorder.orderno IS NULL THEN 2 WHEN storeitemorder.orderno < 0 THEN 1 ELSE 0 END AS section
+				FROM shopping_list
+					JOIN items ON items.itemid = shopping_list.itemid
+					LEFT JOIN storeitemorder ON (storeitemorder.storeid = ?) AND (storeitemorder.itemid = shopping_list.itemid)
+				WHERE shopping_list.itemcount > 0
+				ORDER BY section, storeitemorder.orderno, items.description COLLATE NOCASE;
+			""", (storeid, )).fetchall()
+			return (self.get_changeno(), [ (itemid, item_name, count, self._STORE_SECTIONS[section]) for (itemid, item_name, count, section) in entries ])
+
+	def get_all(self, compact = False, at = None):
+		# If a time is given, the shopping list is the one reconstructed for
+		# that time (see get_shopping_list_at()), everything else is current.
+		with self._read_snapshot():
+			data = {
+				"changeno":			self.get_changeno(),
+				"shopping_list":	self.get_shopping_list() if (at is None) else self._get_shopping_list_at(at),
+				"items":			self.get_item_list(),
+				"item_aliases":		self.get_item_aliases(),
+				"stores":			self.get_stores(compact = compact),
+			}
+			if at is not None:
+				data["at"] = at.strftime("%Y-%m-%dT%H:%M:%SZ")
+			return data
+
+	@staticmethod
+	def _to_columns(rows, names):
+		columns = { name: [ ] for name in names }
+		for row in rows:
+			for (name, value) in zip(names, row):
+				columns[name].append(value)
+		return columns
+
+	def get_all_columnar(self, at = None):
+		# Same content as get_all(compact = True), but every collection is
+		# represented as parallel arrays instead of a dictionary keyed by ID.
+		with self._read_snapshot():
+			stores = self.get_stores(compact = True)
+			if at is None:
+				shopping_list = self._read_cursor.execute("SELECT itemid, itemcount FROM shopping_list WHERE itemcount > 0 ORDER BY itemid;").fetchall()
+			else:
+				shopping_list = sorted(self._get_shopping_list_at(at).items())
+			data = {
+				"format":			"columnar",
+				"changeno":			self.get_changeno(),
+				"shopping_list":	self._to_columns(shopping_list, [ "itemid", "count" ]),
+				"items":			self._to_columns(self._read_cursor.execute("SELECT itemid, description FROM items ORDER BY itemid;"), [ "itemid", "name" ]),
+				"item_aliases":		self._to_columns(self._read_cursor.execute("SELECT description, itemid FROM item_alias_names ORDER BY description;"), [ "name", "itemid" ]),
+				"stores":			self._to_columns(((store["storeid"], storename, store["order"]) for (storename, store) in stores.items()), [ "storeid", "name", "order" ]),
+			}
+			if at is not None:
+				data["at"] = at.strftime("%Y-%m-%dT%H:%M:%SZ")
+			return data
+
+	def get_changes(self, since, compact = False):
+		# Shopping list entries are included even when their count dropped to
+		# zero so that clients can remove them.
+		with self._read_snapshot():
+			return {
+				"changeno":			self.get_changeno(),
+				"shopping_list":	{ itemid: itemcount for (itemid, itemcount) in self._read_cursor.execute("SELECT itemid, itemcount FROM shopping_list WHERE changeno > ?;", (since, )).fetchall() },
+				"items":			{ itemid: description for (itemid, description) in self._read_cursor.execute("SELECT itemid, description FROM items WHERE changeno > ?;", (since, )).fetchall() },
+				"item_aliases":		{ description: itemid for (description, itemid) in self._read_cursor.execute("SELECT description, itemid FROM item_alias_names WHERE changeno > ?;", (since, )).fetchall() },
+				"stores":			self.get_stores(since = since, compact = compact),
+			}
+
+	def _get_storeid(self, store_name):
+		storeid = self._cursor.execute("SELECT storeid FROM stores WHERE storename = ?;", (store_name, )).fetchone()
+		if storeid is not None:
+			return storeid[0]
 
 	def add_store(self, store_name):
-		with contextlib.suppress(sqlite3.IntegrityError):
-			self._cursor.execute("INSERT INTO stores (storename) VALUES (?);", (store_name, ))
-			self._db.commit()
-		return self._cursor.execute("SELECT storeid FROM stores WHERE storename = ?;", (store_name, )).fetchone()[0]
+		storeid = self._get_storeid(store_name)
+		if storeid is None:
+			try:
+				self._cursor.execute("INSERT INTO stores (storename, changeno) VALUES (?, ?);", (store_name, self._next_changeno()))
+				self._commit()
+			except sqlite3.IntegrityError:
+				# Created concurrently by another process
+				self._rollback()
+			storeid = self._get_storeid(store_name)
+		return storeid
 
 	def reset_store_order(self, storeid):
 		self._cursor.execute("DELETE FROM storeitemorder WHERE storeid = ?", (storeid, ))
-		self._db.commit()
+		self._cursor.execute("UPDATE stores SET changeno = ? WHERE storeid = ?;", (self._next_changeno(), storeid))
+		self._commit()
 
-	def set_store_order(self, storeid, item_orders):
-		for (itemid, orderno) in sorted(item_orders.items()):
-			self._cursor.execute("INSERT INTO storeitemorder (storeid, itemid, orderno) VALUES (?, ?, ?);", (storeid, itemid, orderno))
-		self._db.commit()
+	def set_store_order(self, storeid, item_orders, replace = False):
+		# With replace = True, the previous order of the store is discarded
+		# within the same database transaction.
+		if replace:
+			self._cursor.execute("DELETE FROM storeitemorder WHERE storeid = ?", (storeid, ))
+		self._cursor.executemany("INSERT INTO storeitemorder (storeid, itemid, orderno) VALUES (?, ?, ?) ON CONFLICT(storeid, itemid) DO UPDATE SET orderno = excluded.orderno;", ((storeid, itemid, orderno) for (itemid, orderno) in sorted(item_orders.items())))
+		self._cursor.execute("UPDATE stores SET changeno = ? WHERE storeid = ?;", (self._next_changeno(), storeid))
+		self._commit()
+
+	def _get_itemid(self, item_name):
+		itemid = self._cursor.execute("SELECT itemid FROM items WHERE description = ?;", (item_name, )).fetchone()
+		if itemid is not None:
+			return itemid[0]
+
+	def _add_item_lookups(self, is_alias, items):
+		# Adds the normalized names of new items or aliases, given as
+		# (description, itemid) tuples, to item_lookup.
+		self._cursor.executemany("INSERT INTO item_lookup (normalized, is_alias, description, itemid) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING;", ((ItemSearchIndex.normalize(description), is_alias, description, itemid) for (description, itemid) in items))
 
 	def add_item(self, item_name, commit = True):
-		with contextlib.suppress(sqlite3.IntegrityError):
-			self._cursor.execute("INSERT INTO items (description) VALUES (?);", (item_name, ))
-			if commit:
-				self._db.commit()
-		return self._cursor.execute("SELECT itemid FROM items WHERE description = ?;", (item_name, )).fetchone()[0]
+		itemid = self._get_itemid(item_name)
+		if itemid is None:
+			try:
+				self._cursor.execute("INSERT INTO items (description, changeno) VALUES (?, ?);", (item_name, self._next_changeno()))
+				self._add_item_lookups(0, [ (item_name, self._cursor.lastrowid) ])
+				if commit:
+					self._commit()
+			except sqlite3.IntegrityError:
+				# Created concurrently by another process
+				if commit:
+					self._rollback()
+			itemid = self._get_itemid(item_name)
+		return itemid
 
 	def add_items(self, item_names):
-		item_ids = { }
-		for item_name in item_names:
-			item_ids[item_name] = self.add_item(item_name, commit = False)
-		self._db.commit()
+		# Names are resolved in bulk by joining a temporary table against the
+		# items instead of querying for each name individually.
+		self._cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_item_names (description varchar PRIMARY KEY);")
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		try:
+			self._cursor.execute("DELETE FROM temp.import_item_names;")
+			self._cursor.executemany("INSERT INTO temp.import_item_names (description) VALUES (?) ON CONFLICT DO NOTHING;", ((item_name, ) for item_name in item_names))
+			(new_item_count, ) = self._cursor.execute("SELECT COUNT(*) FROM temp.import_item_names LEFT JOIN items ON temp.import_item_names.description = items.description WHERE items.itemid IS NULL;").fetchone()
+			changeno = None
+			if new_item_count > 0:
+				changeno = self._next_changeno()
+				self._cursor.execute("INSERT INTO items (description, changeno) SELECT description, ? FROM temp.import_item_names WHERE true ON CONFLICT DO NOTHING;", (changeno, ))
+			item_ids = { }
+			new_items = [ ]
+			for (description, itemid, item_changeno) in self._cursor.execute("SELECT items.description, items.itemid, items.changeno FROM temp.import_item_names JOIN items ON temp.import_item_names.description = items.description;").fetchall():
+				item_ids[description] = itemid
+				if item_changeno == changeno:
+					new_items.append((description, itemid))
+			self._add_item_lookups(0, new_items)
+			self._cursor.execute("DELETE FROM temp.import_item_names;")
+			self._commit()
+		except Exception:
+			self._rollback()
+			raise
 		return item_ids
 
 	def add_item_alias(self, itemid, alias_name):
 		(count, ) = self._cursor.execute("SELECT COUNT(*) FROM items WHERE description = ?;", (alias_name, )).fetchone()
 		if count == 0:
-			self._cursor.execute("INSERT INTO item_alias_names (itemid, description) VALUES (?, ?);", (itemid, alias_name))
-			self._db.commit()
+			try:
+				self._cursor.execute("INSERT INTO item_alias_names (itemid, description, changeno) VALUES (?, ?, ?);", (itemid, alias_name, self._next_changeno()))
+				self._add_item_lookups(1, [ (alias_name, itemid) ])
+				self._commit()
+			except sqlite3.IntegrityError:
+				self._rollback()
+				raise
 		else:
 			raise OperationalException("Item with name '%s' already exists as a main item, cannot add alias by that same name.")
 
-	def process_transaction(self, transactionid, itemid, delta, user):
+	def _apply_transaction(self, transactionid, itemid, delta, user, processed_utc, changeno):
+		# Must be called while holding the write lock. The primary key of the
+		# history table makes transactions idempotent: a transaction ID that
+		# was already processed conflicts and leaves the list untouched.
 		if delta == 0:
-			# Discard
-			return
+			return "discarded"
 
-		(count, ) = self._cursor.execute("SELECT COUNT(*) FROM history WHERE transactionid = ?;", (transactionid, )).fetchone()
-		if count != 0:
-			# Transaction already processed, discard.
-			return
+		self._cursor.execute("INSERT INTO history (transactionid, itemid, delta, user, processed_utc, changeno) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(transactionid) DO NOTHING;", (transactionid, itemid, delta, user, processed_utc, changeno))
+		if self._cursor.rowcount == 0:
+			return "duplicate"
+
+		if delta > 0:
+			self._cursor.execute("INSERT INTO shopping_list (itemid, itemcount, last_edited_utc, changeno) VALUES (?, ?, ?, ?) ON CONFLICT(itemid) DO UPDATE SET itemcount = itemcount + excluded.itemcount, last_edited_utc = excluded.last_edited_utc, changeno = excluded.changeno;", (itemid, delta, processed_utc, changeno))
+		else:
+			# The row proposed by an upsert must satisfy the CHECK constraint
+			# by itself even when it conflicts, therefore decrements update
+			# the existing entry directly.
+			self._cursor.execute("UPDATE shopping_list SET itemcount = itemcount + ?, last_edited_utc = ?, changeno = ? WHERE itemid = ?;", (delta, processed_utc, changeno, itemid))
+			if self._cursor.rowcount == 0:
+				raise sqlite3.IntegrityError("Item %d is not on the shopping list, count cannot become negative." % (itemid))
+		return "applied"
+
+	def _resolve_item_name(self, item_name):
+		# An exact match of the name is preferred, then main names over
+		# aliases, then the oldest item.
+		itemid = self._cursor.execute("SELECT itemid FROM item_lookup WHERE normalized = ? ORDER BY description = ? DESC, is_alias, itemid LIMIT 1;", (ItemSearchIndex.normalize(item_name), item_name)).fetchone()
+		if itemid is not None:
+			return itemid[0]
+
+	def _apply_named_transaction(self, transactionid, item_name, delta, user, processed_utc, changeno, create):
+		# Returns (status, itemid). The status is "unknown" if no item of that
+		# name exists and it may not be created. An item created for a
+		# transaction that is not applied is removed again and the returned
+		# itemid is None.
+		item_name = " ".join(item_name.split())
+		if item_name == "":
+			raise OperationalException("Item name must not be empty.")
+		itemid = self._resolve_item_name(item_name)
+		if itemid is not None:
+			return (self._apply_transaction(transactionid, itemid, delta, user, processed_utc, changeno), itemid)
+		if not create:
+			return ("unknown", None)
 
-		# Transaction timestamp
+		self._cursor.execute("SAVEPOINT named_transaction_item;")
+		self._cursor.execute("INSERT INTO items (description, changeno) VALUES (?, ?);", (item_name, changeno))
+		itemid = self._cursor.lastrowid
+		self._add_item_lookups(0, [ (item_name, itemid) ])
+		status = self._apply_transaction(transactionid, itemid, delta, user, processed_utc, changeno)
+		if status != "applied":
+			self._cursor.execute("ROLLBACK TO named_transaction_item;")
+			itemid = None
+		self._cursor.execute("RELEASE named_transaction_item;")
+		return (status, itemid)
+
+	def process_named_transaction(self, transactionid, item_name, delta, user, create = True):
+		# Like process_transaction(), but the item is given by a name that is
+		# resolved case, whitespace and diacritic insensitively against item
+		# names and aliases. Unless create is False, a missing item is created
+		# in the same database transaction. Returns (status, itemid).
+		processed_utc = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		try:
+			(status, itemid) = self._apply_named_transaction(transactionid, item_name, delta, user, processed_utc, self._next_changeno(), create)
+			if status == "applied":
+				self._checkpoint_if_due(processed_utc, 1)
+				self._commit()
+			else:
+				self._rollback()
+		except Exception:
+			self._rollback()
+			raise
+		return (status, itemid)
+
+	def process_transaction(self, transactionid, itemid, delta, user):
+		# Returns "applied", "duplicate" or "discarded" (delta of zero). Raises
+		# sqlite3.IntegrityError if the item count would become negative.
+		processed_utc = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		try:
+			status = self._apply_transaction(transactionid, itemid, delta, user, processed_utc, self._next_changeno())
+			if status == "applied":
+				self._checkpoint_if_due(processed_utc, 1)
+				self._commit()
+			else:
+				self._rollback()
+		except Exception:
+			self._rollback()
+			raise
+		return status
+
+	def process_transactions(self, transactions, user):
+		# Processes a list of (transactionid, itemid, delta) tuples in a single
+		# database transaction. Returns the status of each transaction, which
+		# is one of "applied", "duplicate", "discarded" (delta of zero) or
+		# "rejected" (e.g., item count would become negative).
 		processed_utc = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+		results = [ ]
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		try:
+			changeno = self._next_changeno()
+			for (transactionid, itemid, delta) in transactions:
+				self._cursor.execute("SAVEPOINT single_transaction;")
+				try:
+					results.append(self._apply_transaction(transactionid, itemid, delta, user, processed_utc, changeno))
+				except sqlite3.IntegrityError:
+					self._cursor.execute("ROLLBACK TO single_transaction;")
+					results.append("rejected")
+				self._cursor.execute("RELEASE single_transaction;")
+			if "applied" in results:
+				self._checkpoint_if_due(processed_utc, results.count("applied"))
+				self._commit()
+			else:
+				self._rollback()
+		except Exception:
+			self._rollback()
+			raise
+		return results
+
+	def process_batch(self, operations):
+		# Applies ("transaction", transactionid, itemid, delta, user),
+		# ("named_transaction", transactionid, item_name, delta, user, create)
+		# and ("add_item", item_name) operations, possibly of different users,
+		# in a single database transaction. Every operation is isolated by a
+		# savepoint. Returns one result per operation: the transaction status,
+		# (status, itemid) for named transactions or the item ID, or the
+		# exception the operation failed with.
+		processed_utc = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+		results = [ ]
+		modified = False
+		applied_count = 0
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		try:
+			changeno = None
+			for operation in operations:
+				if (operation[0] in [ "transaction", "named_transaction" ]) and (changeno is None):
+					# Outside of the savepoint so that it is not rolled back
+					# together with a rejected transaction.
+					changeno = self._next_changeno()
+				self._cursor.execute("SAVEPOINT batch_operation;")
+				try:
+					if operation[0] == "transaction":
+						(transactionid, itemid, delta, user) = operation[1 : ]
+						result = self._apply_transaction(transactionid, itemid, delta, user, processed_utc, changeno)
+						applied_count += int(result == "applied")
+					elif operation[0] == "named_transaction":
+						(transactionid, item_name, delta, user, create) = operation[1 : ]
+						result = self._apply_named_transaction(transactionid, item_name, delta, user, processed_utc, changeno, create)
+						applied_count += int(result[0] == "applied")
+					elif operation[0] == "add_item":
+						result = self.add_item(operation[1], commit = False)
+						modified = modified or (self._pending_changeno != changeno)
+					else:
+						raise OperationalException("Unsupported batch operation: %s" % (operation[0]))
+				except (sqlite3.IntegrityError, OperationalException) as e:
+					self._cursor.execute("ROLLBACK TO batch_operation;")
+					result = e
+				self._cursor.execute("RELEASE batch_operation;")
+				results.append(result)
+			if applied_count > 0:
+				self._checkpoint_if_due(processed_utc, applied_count)
+			if modified or (applied_count > 0):
+				self._commit()
+			else:
+				self._rollback()
+		except Exception:
+			self._rollback()
+			raise
+		return results
+
+	def get_property(self, key, default = None):
+		value = self._read_cursor.execute("SELECT value FROM properties WHERE key = ?;", (key, )).fetchone()
+		if value is None:
+			return default
+		else:
+			return value[0]
+
+	def _set_property(self, key, value):
+		self._cursor.execute("INSERT INTO properties (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value;", (key, value))
+
+	def _refresh_statistics(self):
+		# Must be called within a write transaction. Only history entries
+		# with a change number above the one recorded at the previous refresh
+		# are considered, i.e., the work is proportional to the number of new
+		# entries. All aggregation is done by SQLite.
+		statistics_changeno = self._cursor.execute("SELECT value FROM properties WHERE key = 'statistics_changeno';").fetchone()
+		self._cursor.execute("CREATE TEMP TABLE IF NOT EXISTS new_purchase_days (day varchar NOT NULL, itemid integer NOT NULL, PRIMARY KEY(day, itemid));")
+		self._cursor.execute("DELETE FROM new_purchase_days;")
+		if statistics_changeno is None:
+			# Initial computation, also take into account history that has
+			# already been compacted. Entries which predate change numbers
+			# carry change number zero.
+			since = -1
+			self._cursor.execute("INSERT OR IGNORE INTO new_purchase_days (day, itemid) SELECT day, itemid FROM history_daily WHERE additions > 0;")
+		else:
+			since = statistics_changeno[0]
+		self._cursor.execute("INSERT OR IGNORE INTO new_purchase_days (day, itemid) SELECT substr(processed_utc, 1, 10), itemid FROM history WHERE (changeno > ?) AND (delta > 0);", (since, ))
+		self._cursor.execute("DELETE FROM new_purchase_days WHERE EXISTS (SELECT 1 FROM item_purchase_days WHERE (item_purchase_days.day = new_purchase_days.day) AND (item_purchase_days.itemid = new_purchase_days.itemid));")
+
+		# New days pair up with days already known and with each other.
+		self._cursor.execute("""
+			INSERT INTO item_cooccurrence (itemid1, itemid2, days)
+				SELECT itemid1, itemid2, SUM(days) FROM (
+					SELECT MIN(new.itemid, known.itemid) AS itemid1, MAX(new.itemid, known.itemid) AS itemid2, COUNT(*) AS days
+						FROM new_purchase_days AS new JOIN item_purchase_days AS known ON known.day = new.day
+						GROUP BY 1, 2
+					UNION ALL
+					SELECT a.itemid, b.itemid, COUNT(*)
+						FROM new_purchase_days AS a JOIN new_purchase_days AS b ON (b.day = a.day) AND (a.itemid < b.itemid)
+						GROUP BY 1, 2
+				) WHERE true GROUP BY itemid1, itemid2
+			ON CONFLICT(itemid1, itemid2) DO UPDATE SET days = days + excluded.days;
+		""")
+		self._cursor.execute("""
+			INSERT INTO item_statistics (itemid, purchase_days, first_day, last_day)
+				SELECT itemid, COUNT(*), MIN(day), MAX(day) FROM new_purchase_days WHERE true GROUP BY itemid
+			ON CONFLICT(itemid) DO UPDATE SET
+				purchase_days = purchase_days + excluded.purchase_days,
+				first_day = MIN(first_day, excluded.first_day),
+				last_day = MAX(last_day, excluded.last_day);
+		""")
+		self._cursor.execute("INSERT INTO item_purchase_days (day, itemid) SELECT day, itemid FROM new_purchase_days;")
+		self._cursor.execute("DELETE FROM new_purchase_days;")
+
+		changeno = self._cursor.execute("SELECT value FROM properties WHERE key = 'changeno';").fetchone()
+		self._set_property("statistics_changeno", 0 if (changeno is None) else changeno[0])
+
+	def refresh_statistics(self):
+		# Purchase statistics are derived data and do not advance the change
+		# number. When nothing changed, no write transaction is started. Only
+		# uses the write connection.
+		(statistics_changeno, changeno) = self._cursor.execute("SELECT (SELECT value FROM properties WHERE key = 'statistics_changeno'), IFNULL((SELECT value FROM properties WHERE key = 'changeno'), 0);").fetchone()
+		if statistics_changeno == changeno:
+			return
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		try:
+			self._refresh_statistics()
+			self._commit()
+		except Exception:
+			self._rollback()
+			raise
+
+	def get_item_statistics(self):
+		# Returns { itemid: (purchase_days, first_day, last_day) }
+		return { itemid: (purchase_days, first_day, last_day) for (itemid, purchase_days, first_day, last_day) in self._read_cursor.execute("SELECT itemid, purchase_days, first_day, last_day FROM item_statistics;").fetchall() }
+
+	def get_shopping_list_cooccurrences(self):
+		# Returns (itemid, other itemid, days) tuples for all items that are
+		# on the shopping list and were bought together with another item.
+		return self._read_cursor.execute("""
+			SELECT shopping_list.itemid, item_cooccurrence.itemid2, item_cooccurrence.days FROM shopping_list JOIN item_cooccurrence ON item_cooccurrence.itemid1 = shopping_list.itemid WHERE shopping_list.itemcount > 0
+			UNION ALL
+			SELECT shopping_list.itemid, item_cooccurrence.itemid1, item_cooccurrence.days FROM shopping_list JOIN item_cooccurrence ON item_cooccurrence.itemid2 = shopping_list.itemid WHERE shopping_list.itemcount > 0;
+		""").fetchall()
 
-		# Get current value
-		itemcount = self._cursor.execute("SELECT itemcount FROM shopping_list WHERE itemid = ?;", (itemid, )).fetchone()
-		if itemcount is None:
-			# Value is not in table at all.
-			itemcount = 0
-			self._cursor.execute("INSERT INTO shopping_list (itemid, itemcount, last_edited_utc) VALUES (?, ?, ?);", (itemid, 0, processed_utc))
+	# History entries after a checkpoint in (processed_utc, changeno) order,
+	# found through the processed_utc index. Parameters are created_utc,
+	# created_utc and changeno of the checkpoint.
+	_HISTORY_AFTER_CHECKPOINT = "(processed_utc >= ?) AND ((processed_utc > ?) OR (changeno > ?))"
+
+	def _create_checkpoint(self, created_utc, changeno):
+		self._cursor.execute("INSERT INTO checkpoints (created_utc, changeno) VALUES (?, ?);", (created_utc, changeno))
+		self._cursor.execute("INSERT INTO checkpoint_items (checkpointid, itemid, itemcount) SELECT ?, itemid, itemcount FROM shopping_list WHERE itemcount > 0;", (self._cursor.lastrowid, ))
+		self._set_property("transactions_since_checkpoint", 0)
+
+	def _checkpoint_if_due(self, processed_utc, applied_count):
+		# Must be called within a write transaction after the last
+		# transaction in it has been applied, with the number of transactions
+		# it applied. A checkpoint is taken when enough transactions or
+		# enough time have accumulated since the most recent one; this bounds
+		# the part of the history that get_shopping_list_at() needs to
+		# replay. The transactions are counted in a property instead of in
+		# the history so that the check stays cheap.
+		(last_created_utc, transaction_count) = self._cursor.execute("SELECT (SELECT created_utc FROM checkpoints ORDER BY created_utc DESC, changeno DESC LIMIT 1), IFNULL((SELECT value FROM properties WHERE key = 'transactions_since_checkpoint'), 0);").fetchone()
+		transaction_count += applied_count
+		if last_created_utc is not None:
+			due_utc = (datetime.datetime.strptime(last_created_utc, "%Y-%m-%dT%H:%M:%SZ") + datetime.timedelta(minutes = self._checkpoint_minutes)).strftime("%Y-%m-%dT%H:%M:%SZ")
+			if (processed_utc < due_utc) and (transaction_count < self._checkpoint_transactions):
+				self._set_property("transactions_since_checkpoint", transaction_count)
+				return
+		self._create_checkpoint(processed_utc, self._pending_changeno)
+
+	def _get_checkpoint(self, timestamp = None):
+		# (checkpointid, created_utc, changeno) of the most recent checkpoint
+		# (at the given time, if any). As long as no history was compacted,
+		# the empty list before the first transaction serves as checkpoint.
+		if timestamp is None:
+			checkpoint = self._read_cursor.execute("SELECT checkpointid, created_utc, changeno FROM checkpoints ORDER BY created_utc DESC, changeno DESC LIMIT 1;").fetchone()
 		else:
-			itemcount = itemcount[0]
+			checkpoint = self._read_cursor.execute("SELECT checkpointid, created_utc, changeno FROM checkpoints WHERE created_utc <= ? ORDER BY created_utc DESC, changeno DESC LIMIT 1;", (timestamp, )).fetchone()
+		if checkpoint is not None:
+			return checkpoint
+		if self._read_cursor.execute("SELECT EXISTS (SELECT 1 FROM history_daily);").fetchone()[0]:
+			earliest = self._read_cursor.execute("SELECT MIN(created_utc) FROM checkpoints;").fetchone()[0]
+			raise OperationalException("History has been compacted, the shopping list can only be reconstructed from %s on." % (earliest))
+		return (None, "", -1)
 
-		# Update item count
-		self._cursor.execute("UPDATE shopping_list SET itemcount = itemcount + ?, last_edited_utc = ? WHERE itemid = ?;", (delta, processed_utc, itemid))
+	def _get_shopping_list_at(self, at):
+		# Relies on a clock that does not go backwards, i.e., on history
+		# entries of later database transactions never having an earlier
+		# processing time.
+		timestamp = at.strftime("%Y-%m-%dT%H:%M:%SZ")
+		(checkpointid, created_utc, changeno) = self._get_checkpoint(timestamp)
+		return { itemid: itemcount for (itemid, itemcount) in self._read_cursor.execute("""
+			SELECT itemid, SUM(itemcount) FROM (
+				SELECT itemid, itemcount FROM checkpoint_items WHERE checkpointid = ?
+				UNION ALL
+				SELECT itemid, delta FROM history WHERE %s AND (processed_utc <= ?)
+			) GROUP BY itemid HAVING SUM(itemcount) > 0;
+		""" % (self._HISTORY_AFTER_CHECKPOINT), (checkpointid, created_utc, created_utc, changeno, timestamp)).fetchall() }
 
-		# Insert transaction history item
-		self._cursor.execute("INSERT INTO history (transactionid, itemid, delta, user, processed_utc) VALUES (?, ?, ?, ?, ?);", (transactionid, itemid, delta, user, processed_utc))
+	def get_shopping_list_at(self, at):
+		# Reconstructs the shopping list as it was at the given UTC time from
+		# the closest preceding checkpoint and the history entries after it.
+		# Raises OperationalException if the time precedes compacted history.
+		with self._read_snapshot():
+			return self._get_shopping_list_at(at)
+
+	def get_checkpoints(self):
+		return self._read_cursor.execute("SELECT checkpoints.created_utc, checkpoints.changeno, COUNT(checkpoint_items.itemid) FROM checkpoints LEFT JOIN checkpoint_items ON checkpoint_items.checkpointid = checkpoints.checkpointid GROUP BY checkpoints.checkpointid ORDER BY checkpoints.created_utc, checkpoints.changeno;").fetchall()
+
+	def check_integrity(self):
+		# Verifies that the current shopping list equals the most recent
+		# checkpoint plus all history entries after it. Returns the
+		# checkpoint that was used (None for the empty list) and a list of
+		# (itemid, expected, actual) for every item whose count differs.
+		with self._read_snapshot():
+			(checkpointid, created_utc, changeno) = self._get_checkpoint()
+			mismatches = self._read_cursor.execute("""
+				SELECT itemid, SUM(expected), SUM(actual) FROM (
+					SELECT itemid, itemcount AS expected, 0 AS actual FROM checkpoint_items WHERE checkpointid = ?
+					UNION ALL
+					SELECT itemid, delta, 0 FROM history WHERE %s
+					UNION ALL
+					SELECT itemid, 0, itemcount FROM shopping_list
+				) GROUP BY itemid HAVING SUM(expected) != SUM(actual) ORDER BY itemid;
+			""" % (self._HISTORY_AFTER_CHECKPOINT), (checkpointid, created_utc, created_utc, changeno)).fetchall()
+			return {
+				"checkpoint_utc":	created_utc if (checkpointid is not None) else None,
+				"mismatches":		mismatches,
+			}
+
+	# Record types of the export format in the order in which they are
+	# written, so that referenced rows are always imported first. Derived
+	# data (such as purchase statistics) is not exported.
+	_EXPORT_TABLES = [
+		("item",			"items",			("itemid", "description", "changeno")),
+		("alias",			"item_alias_names",	("description", "itemid", "changeno")),
+		("store",			"stores",			("storeid", "storename", "changeno")),
+		("store_order",		"storeitemorder",	("storeid", "itemid", "orderno")),
+		("shopping_list",	"shopping_list",	("itemid", "itemcount", "last_edited_utc", "changeno")),
+		("history",			"history",			("transactionid", "itemid", "delta", "user", "processed_utc", "changeno")),
+		("history_daily",	"history_daily",	("day", "itemid", "user", "added", "removed", "additions", "removals")),
+		("checkpoint",		"checkpoints",		("checkpointid", "created_utc", "changeno")),
+		("checkpoint_item",	"checkpoint_items",	("checkpointid", "itemid", "itemcount")),
+	]
+
+	def export_records(self):
+		# Generator of one dictionary per row of a consistent snapshot of the
+		# database, preceded by a header record. Rows are fetched
+		# incrementally, i.e., memory usage does not depend on database size.
+		# Each table is walked with its own cursor on the read connection,
+		# which is opened through the _read_cursor property if necessary.
+		self._read_cursor
+		with self._read_snapshot():
+			yield {
+				"type":				"header",
+				"schema_version":	self._get_schema_version(),
+				"changeno":			self.get_changeno(),
+			}
+			for (record_type, table_name, columns) in self._EXPORT_TABLES:
+				cursor = self._create_cursor(self._read_db)
+				for row in cursor.execute("SELECT %s FROM %s ORDER BY %s;" % (", ".join(columns), table_name, columns[0])):
+					record = { "type": record_type }
+					record.update(zip(columns, row))
+					yield record
+
+	def _import_rows(self, table_name, columns, rows):
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		try:
+			self._cursor.executemany("INSERT INTO %s (%s) VALUES (%s);" % (table_name, ", ".join(columns), ", ".join([ "?" ] * len(columns))), rows)
+			is_alias = { "items": 0, "item_alias_names": 1 }.get(table_name)
+			if is_alias is not None:
+				(description_index, itemid_index) = (columns.index("description"), columns.index("itemid"))
+				self._add_item_lookups(is_alias, ((row[description_index], row[itemid_index]) for row in rows))
+			self._db.commit()
+		except Exception:
+			self._db.rollback()
+			raise
+
+	def import_records(self, records, chunk_size = 10000):
+		# Restores records as produced by export_records() into an empty
+		# database. Rows are committed in chunks so that memory usage stays
+		# constant; an interrupted import therefore leaves a partially filled
+		# database behind and needs to be repeated with a new file.
+		if self._cursor.execute("SELECT EXISTS (SELECT 1 FROM items) OR EXISTS (SELECT 1 FROM history);").fetchone()[0]:
+			raise OperationalException("Records can only be imported into an empty database.")
+		tables = { record_type: (table_name, columns) for (record_type, table_name, columns) in self._EXPORT_TABLES }
+		counts = { record_type: 0 for record_type in tables }
+		header = None
+		(batch_type, batch) = (None, [ ])
+		for record in records:
+			record_type = record.get("type")
+			if header is None:
+				if record_type != "header":
+					raise OperationalException("Import data must start with a header record.")
+				header = record
+				continue
+			if record_type not in tables:
+				raise OperationalException("Unknown record type '%s' in import data." % (record_type))
+			if ((record_type != batch_type) or (len(batch) >= chunk_size)) and (len(batch) > 0):
+				self._import_rows(*tables[batch_type], batch)
+				batch = [ ]
+			batch_type = record_type
+			batch.append(tuple(record[column] for column in tables[record_type][1]))
+			counts[record_type] += 1
+		if len(batch) > 0:
+			self._import_rows(*tables[batch_type], batch)
+		if header is None:
+			raise OperationalException("Import data is empty.")
+
+		self._cursor.execute("BEGIN IMMEDIATE;")
+		self._set_property("changeno", header["changeno"])
 		self._db.commit()
+		return counts
+
+	def compact_history(self, retention_days, archive_filename = None, vacuum = True):
+		# History entries older than the retention period are rolled up into
+		# daily per-item/per-user aggregates and removed from the history
+		# table. If an archive database is given, the raw entries are moved
+		# there. Note that the history table is what makes transactions
+		# idempotent, i.e., the retention period also bounds the time in
+		# which a repeated transaction ID is recognized as a duplicate.
+		cutoff_utc = (datetime.datetime.utcnow() - datetime.timedelta(days = retention_days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+		if archive_filename is not None:
+			self._cursor.execute("ATTACH DATABASE ? AS archive;", (archive_filename, ))
+		try:
+			self._cursor.execute("BEGIN IMMEDIATE;")
+			try:
+				# Entries that have not yet been included in the purchase
+				# statistics would otherwise only be found in the daily
+				# aggregates after compaction.
+				self._refresh_statistics()
+				self._cursor.execute("""
+					INSERT INTO history_daily (day, itemid, user, added, removed, additions, removals)
+						SELECT substr(processed_utc, 1, 10), itemid, user,
+							SUM(MAX(delta, 0)), SUM(MAX(-delta, 0)), SUM(delta > 0), SUM(delta < 0)
+						FROM history WHERE processed_utc < ? GROUP BY 1, 2, 3
+					ON CONFLICT(day, itemid, user) DO UPDATE SET
+						added = added + excluded.added, removed = removed + excluded.removed,
+						additions = additions + excluded.additions, removals = removals + excluded.removals;
+				""", (cutoff_utc, ))
+				if archive_filename is not None:
+					self._cursor.execute("""
+					CREATE TABLE IF NOT EXISTS archive.history (
+						transactionid uuid NOT NULL PRIMARY KEY,
+						itemid integer NOT NULL,
+						delta integer NOT NULL,
+						user varchar NOT NULL,
+						processed_utc timestamp NOT NULL,
+						changeno integer NOT NULL DEFAULT 0
+					);
+					""")
+					self._cursor.execute("INSERT INTO archive.history (transactionid, itemid, delta, user, processed_utc, changeno) SELECT transactionid, itemid, delta, user, processed_utc, changeno FROM main.history WHERE processed_utc < ? ON CONFLICT DO NOTHING;", (cutoff_utc, ))
+					archived = self._cursor.rowcount
+				else:
+					archived = 0
+				# Reconstruction of older shopping lists must not replay
+				# across the removed entries: the list as it was after the
+				# last of them becomes a checkpoint (derived backwards from
+				# the current list and the entries that are kept) and older
+				# checkpoints are dropped.
+				horizon = self._cursor.execute("SELECT processed_utc, changeno FROM main.history WHERE processed_utc < ? ORDER BY processed_utc DESC, changeno DESC LIMIT 1;", (cutoff_utc, )).fetchone()
+				if horizon is not None:
+					(horizon_utc, horizon_changeno) = horizon
+					if not self._cursor.execute("SELECT EXISTS (SELECT 1 FROM checkpoints WHERE (created_utc = ?) AND (changeno = ?));", (horizon_utc, horizon_changeno)).fetchone()[0]:
+						self._cursor.execute("INSERT INTO checkpoints (created_utc, changeno) VALUES (?, ?);", (horizon_utc, horizon_changeno))
+						self._cursor.execute("""
+							INSERT INTO checkpoint_items (checkpointid, itemid, itemcount)
+								SELECT ?, itemid, SUM(itemcount) FROM (
+									SELECT itemid, itemcount FROM shopping_list
+									UNION ALL
+									SELECT itemid, -delta FROM main.history WHERE processed_utc >= ?
+								) GROUP BY itemid HAVING SUM(itemcount) > 0;
+						""", (self._cursor.lastrowid, cutoff_utc))
+					older_checkpoints = "SELECT checkpointid FROM checkpoints WHERE (created_utc < ?) OR ((created_utc = ?) AND (changeno < ?))"
+					self._cursor.execute("DELETE FROM checkpoint_items WHERE checkpointid IN (%s);" % (older_checkpoints), (horizon_utc, horizon_utc, horizon_changeno))
+					self._cursor.execute("DELETE FROM checkpoints WHERE checkpointid IN (%s);" % (older_checkpoints), (horizon_utc, horizon_utc, horizon_changeno))
+				self._cursor.execute("DELETE FROM main.history WHERE processed_utc < ?;", (cutoff_utc, ))
+				compacted = self._cursor.rowcount
+				self._set_property("last_compaction_utc", datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"))
+				self._db.commit()
+			except Exception:
+				self._db.rollback()
+				raise
+		finally:
+			if archive_filename is not None:
+				self._cursor.execute("DETACH DATABASE archive;")
+
+		if vacuum:
+			self._cursor.execute("VACUUM;")
+		self._cursor.execute("PRAGMA optimize;")
+		return {
+			"cutoff_utc":	cutoff_utc,
+			"compacted":	compacted,
+			"archived":		archived,
+		}
 
 if __name__ == "__main__":
 	import uuid
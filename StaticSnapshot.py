@@ -0,0 +1,75 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import os
+import json
+import gzip
+import fcntl
+import contextlib
+import tempfile
+
+class StaticSnapshot():
+	"""Materialized copy of the /all response (in columnar format) that is
+	rewritten after every change so that the web server can deliver it as a
+	static file without running the CGI script. Next to the JSON file, a
+	precompressed .gz version is kept."""
+
+	def __init__(self, filename):
+		self._filename = filename
+
+	@property
+	def filename(self):
+		return self._filename
+
+	@staticmethod
+	def encode(data):
+		return json.dumps({
+			"success": True,
+			"msg": "all",
+			"data": data,
+		}, separators = (",", ":")).encode("utf-8")
+
+	def _replace_file(self, filename, content):
+		# Write to a temporary file in the same directory and rename it so
+		# that the web server never delivers a partially written file.
+		(fd, tmp_filename) = tempfile.mkstemp(prefix = "." + os.path.basename(filename) + ".", dir = os.path.dirname(filename))
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(content)
+			os.chmod(tmp_filename, 0o644)
+			os.replace(tmp_filename, filename)
+		except:
+			os.unlink(tmp_filename)
+			raise
+
+	def update(self, database, read_lock = None):
+		# Concurrent writers (e.g., multiple CGI processes) are serialized
+		# through a lock file. Because the data is read while holding the
+		# lock, the last writer always leaves the most recent state behind.
+		# A given read lock is only held while reading from the database.
+		with open(self._filename + ".lock", "a") as lockfile:
+			fcntl.flock(lockfile, fcntl.LOCK_EX)
+			with (read_lock if (read_lock is not None) else contextlib.nullcontext()):
+				data = database.get_all_columnar()
+			body = self.encode(data)
+			self._replace_file(self._filename + ".gz", gzip.compress(body))
+			self._replace_file(self._filename, body)
@@ -0,0 +1,81 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import datetime
+
+class Suggestions():
+	"""Derives suggestions from the precomputed purchase statistics: items
+	which are usually bought again about now (from the mean interval between
+	the days on which they were added) and items which are frequently bought
+	together with what is on the shopping list."""
+
+	def __init__(self, statistics, shopping_list, cooccurrences, today = None, min_purchase_days = 3, min_cooccurrence_days = 2):
+		self._statistics = statistics
+		self._shopping_list = shopping_list
+		self._cooccurrences = cooccurrences
+		self._today = today if (today is not None) else datetime.datetime.utcnow().date()
+		self._min_purchase_days = min_purchase_days
+		self._min_cooccurrence_days = min_cooccurrence_days
+
+	@staticmethod
+	def _parse_day(day):
+		return datetime.datetime.strptime(day, "%Y-%m-%d").date()
+
+	def due(self, limit = 10, threshold = 0.8):
+		# Items are due once the time since they were last bought reaches
+		# the given fraction of their mean repurchase interval.
+		results = [ ]
+		for (itemid, (purchase_days, first_day, last_day)) in self._statistics.items():
+			if (purchase_days < self._min_purchase_days) or (self._shopping_list.get(itemid, 0) > 0):
+				continue
+			last_day = self._parse_day(last_day)
+			interval_days = (last_day - self._parse_day(first_day)).days / (purchase_days - 1)
+			days_since = (self._today - last_day).days
+			if (interval_days <= 0) or (days_since / interval_days < threshold):
+				continue
+			results.append({
+				"itemid":			itemid,
+				"interval_days":	round(interval_days, 1),
+				"days_since":		days_since,
+				"due_in_days":		round(interval_days - days_since, 1),
+				"score":			round(days_since / interval_days, 3),
+			})
+		results.sort(key = lambda result: (-result["score"], result["itemid"]))
+		return results[ : limit]
+
+	def related(self, limit = 10):
+		# The score of a candidate is the highest fraction of days on which
+		# an item of the shopping list was bought together with it.
+		best = { }
+		for (itemid, other_itemid, days) in self._cooccurrences:
+			if (days < self._min_cooccurrence_days) or (self._shopping_list.get(other_itemid, 0) > 0) or (itemid not in self._statistics):
+				continue
+			score = days / self._statistics[itemid][0]
+			if (other_itemid not in best) or (score > best[other_itemid]["score"]):
+				best[other_itemid] = {
+					"itemid":		other_itemid,
+					"because_of":	itemid,
+					"days":			days,
+					"score":		round(score, 3),
+				}
+		results = sorted(best.values(), key = lambda result: (-result["score"], result["itemid"]))
+		return results[ : limit]
@@ -0,0 +1,121 @@
+#	pyslist - Python-based shopping list
+#	Copyright (C) 2019-2019 Johannes Bauer
+#
+#	This file is part of pyslist.
+#
+#	pyslist is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pyslist is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pyslist; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import time
+import queue
+import threading
+
+class WriteQueue():
+	"""Group commit for a persistent server: a dedicated writer thread owns a
+	database connection, collects write operations that arrive within a few
+	milliseconds of each other and applies them in one database transaction
+	(see ShoppingListDB.process_batch()). Each submitter receives the result
+	of its own operation."""
+
+	class _Ticket():
+		def __init__(self, operation):
+			self.operation = operation
+			self.result = None
+			self.done = False
+
+	def __init__(self, open_database, delay = 0.005, max_batch = 100):
+		self._lock = threading.Condition()
+		self._closed = False
+		self._delay = delay
+		self._max_batch = max_batch
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target = self._run, args = (open_database, ), daemon = True)
+		self._thread.start()
+
+	def submit(self, operation):
+		# Blocks until the operation has been processed. Returns its result
+		# or raises the exception it failed with.
+		result = self.submit_many([ operation ])[0]
+		if isinstance(result, Exception):
+			raise result
+		return result
+
+	def submit_many(self, operations):
+		# Queues all operations at once so that they are usually applied in
+		# the same batch and blocks until every one has been processed.
+		# Returns their results in order; an operation that failed yields
+		# the exception instead of raising it.
+		tickets = [ self._Ticket(operation) for operation in operations ]
+		with self._lock:
+			if self._closed:
+				raise RuntimeError("Write queue has been closed.")
+			for ticket in tickets:
+				self._queue.put(ticket)
+			while not all(ticket.done for ticket in tickets):
+				self._lock.wait()
+		return [ ticket.result for ticket in tickets ]
+
+	def close(self):
+		# Operations queued before are still processed.
+		with self._lock:
+			self._closed = True
+			self._queue.put(None)
+
+	def _collect(self):
+		ticket = self._queue.get()
+		if ticket is None:
+			return None
+		tickets = [ ticket ]
+		deadline = time.monotonic() + self._delay
+		while len(tickets) < self._max_batch:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			try:
+				ticket = self._queue.get(timeout = remaining)
+			except queue.Empty:
+				break
+			if ticket is None:
+				self._queue.put(None)
+				break
+			tickets.append(ticket)
+		return tickets
+
+	def _run(self, open_database):
+		try:
+			database = open_database()
+			error = None
+		except Exception as e:
+			# Fail every operation instead of leaving submitters waiting
+			database = None
+			error = e
+		while True:
+			tickets = self._collect()
+			if tickets is None:
+				break
+			if database is None:
+				results = [ error ] * len(tickets)
+			else:
+				try:
+					results = database.process_batch([ ticket.operation for ticket in tickets ])
+				except Exception as e:
+					results = [ e ] * len(tickets)
+			with self._lock:
+				for (ticket, result) in zip(tickets, results):
+					ticket.result = result
+					ticket.done = True
+				self._lock.notify_all()
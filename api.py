@@ -20,118 +20,31 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+
 import os
 import sys
-import json
-import uuid
-import random
 from Configuration import Configuration
-from ShoppingListDB import ShoppingListDB
-
-class APIServer():
-	def __init__(self, config):
-		self._config = config
-		self._database = ShoppingListDB(sqlite_dbfile = self._config.db_filename)
-
-	def _execute_GET_all(self, post_data, auth_user):
-		return {
-			"success": True,
-			"msg": "all",
-			"data": self._database.get_all(),
-		}
-
-	def _execute_POST_transaction(self, post_data, auth_user):
-		# Introduce random error
-#		if random.randint(0, 3) != 0:
-#			raise Exception("CALL FAILED")
-
-		transactionid = str(uuid.UUID(post_data.get("transactionid")))
-		itemid = int(post_data.get("itemid"))
-		delta = int(post_data.get("delta"))
-		self._database.process_transaction(transactionid = transactionid, itemid = itemid, delta = delta, user = auth_user)
-		return {
-			"success": True,
-			"msg": "transaction",
-			"transactionid": transactionid,
-		}
-
-	def _execute_GET_debug(self, post_data, auth_user):
-		return {
-			"success": True,
-			"msg": "debug",
-			"data": {
-				"env":			dict(os.environ),
-				"post_data":	post_data,
-				"auth_user":	auth_user,
-			},
-		}
-
-	def _execute_POST_item(self, post_data, auth_user):
-		itemid = self._database.add_item(post_data["name"])
-		return {
-			"success": True,
-			"msg": "add_item",
-			"itemid": itemid,
-		}
-
-	def _get_auth_user(self):
-		return os.getenv("REMOTE_USER")
-
-	def execute(self):
-		request_method = os.getenv("REQUEST_METHOD")
-		if request_method is not None:
-			request_method = request_method.upper()
-		path_info = os.getenv("PATH_INFO")
-		auth_user = self._get_auth_user()
-
-		if auth_user is None:
-			return {
-				"success": False,
-				"error_text": "Cannot determine authenticated user.",
-			}
-
-		if request_method == "POST":
-			# Decode POST data as JSON
-			try:
-				post_data = json.load(sys.stdin)
-			except json.decoder.JSONDecodeError as e:
-				return {
-					"success": False,
-					"error_text": "JSON decoding error: %s" % (str(e)),
-				}
-		else:
-			post_data = None
-
-		if (request_method == "GET") and (path_info == "/all"):
-			response = self._execute_GET_all(post_data = post_data, auth_user = auth_user)
-		elif (request_method == "POST") and (path_info == "/transaction"):
-			response = self._execute_POST_transaction(post_data = post_data, auth_user = auth_user)
-		elif (request_method == "GET") and (path_info == "/debug") and (self._config.debug):
-			response = self._execute_GET_debug(post_data = post_data, auth_user = auth_user)
-		elif (request_method == "POST") and (path_info == "/item"):
-			response = self._execute_POST_item(post_data = post_data, auth_user = auth_user)
-		else:
-			response = {
-				"success": False,
-				"error_text": "Unknown or unsupported REQUEST_METHOD %s / PATH_INFO %s" % (str(request_method), str(path_info)),
-			}
-		return response
+from APIServer import APIServer
 
 config = Configuration.default()
 try:
 	api_server = APIServer(config)
-	response = api_server.execute()
+	response = api_server.handle(os.environ, sys.stdin.buffer)
 except Exception as e:
-	response = {
+	response = APIServer.json_response({
 		"success": False,
 		"error_text": "Exception: %s" % (str(e)),
-	}
-
-if (not config.debug) and ("error_text" in response):
-	response["error_text"] = "Error details unavailable with disabled debugging."
+	}, debug = config.debug)
 
-if not response["success"]:
-	print("Status: 400 Bad Request")
-print("Content-Type: application/json")
+if response.status != "200 OK":
+	print("Status: %s" % (response.status))
+for (key, value) in response.headers:
+	print("%s: %s" % (key, value))
 print()
-print(json.dumps(response, separators = (",", ":")))
+sys.stdout.flush()
+if isinstance(response.body, bytes):
+	sys.stdout.buffer.write(response.body)
+else:
+	for chunk in response.body:
+		sys.stdout.buffer.write(chunk)
+		sys.stdout.buffer.flush()
@@ -33,15 +33,178 @@ function cmpvalue(a, b) {
 	}
 }
 
+class TransactionQueue {
+	/* Outgoing transactions, persisted in localStorage so that they survive
+	 * a reload. Changes of an item that have not been sent yet are coalesced
+	 * into a single transaction. Once sent, a transaction is never modified
+	 * again, so that retries carry the same transaction ID and are recognized
+	 * as duplicates by the server. Applied transactions are kept (with the
+	 * change number the server reported) until the list received from the
+	 * server includes them. Other tabs share the same storage key; entries
+	 * that this tab did not create or load are left untouched. */
+	constructor(storage_key, send_batch, on_change) {
+		this._storage_key = storage_key;
+		this._send_batch = send_batch;
+		this._on_change = on_change;
+		this._entries = this._load();
+		this._owned = new Set(this._entries.map((entry) => entry["transactionid"]));
+		this._acknowledged_changeno = null;
+		this._sending = false;
+		this._timer = null;
+		this._failures = 0;
+	}
+
+	_load() {
+		try {
+			const entries = localStorage.getItem(this._storage_key);
+			return entries ? JSON.parse(entries) : [ ];
+		} catch (exception) {
+			return [ ];
+		}
+	}
+
+	_save() {
+		try {
+			const foreign_entries = this._load().filter((entry) => !this._owned.has(entry["transactionid"]));
+			localStorage.setItem(this._storage_key, JSON.stringify(foreign_entries.concat(this._entries)));
+		} catch (exception) {
+			console.log("Cannot persist transaction queue:", exception);
+		}
+	}
+
+	pending_deltas() {
+		const deltas = { };
+		for (let entry of this._entries) {
+			deltas[entry["itemid"]] = (deltas[entry["itemid"]] || 0) + entry["delta"];
+		}
+		return deltas;
+	}
+
+	_unsent() {
+		return this._entries.filter((entry) => !("changeno" in entry));
+	}
+
+	acknowledge(changeno) {
+		/* The server state up to the given change number has been received */
+		this._acknowledged_changeno = changeno;
+		const count = this._entries.length;
+		this._entries = this._entries.filter((entry) => !("changeno" in entry) || (entry["changeno"] > changeno));
+		if (this._entries.length != count) {
+			this._save();
+		}
+	}
+
+	add(itemid, delta) {
+		const entry = this._entries.find((entry) => (entry["itemid"] == itemid) && !entry["sent"]);
+		if (entry) {
+			entry["delta"] += delta;
+			if (entry["delta"] == 0) {
+				this._entries.splice(this._entries.indexOf(entry), 1);
+			}
+		} else {
+			const transactionid = new_uuid4();
+			this._owned.add(transactionid);
+			this._entries.push({
+				"transactionid":	transactionid,
+				"itemid":			itemid,
+				"delta":			delta,
+				"sent":				false,
+			});
+		}
+		this._save();
+		this._on_change();
+		this._schedule(0.5);
+	}
+
+	_schedule(delay_secs) {
+		if ((this._timer == null) && (this._unsent().length > 0)) {
+			this._timer = setTimeout(() => {
+				this._timer = null;
+				this.send();
+			}, 1000 * delay_secs);
+		}
+	}
+
+	retry_now() {
+		if (this._timer != null) {
+			clearTimeout(this._timer);
+			this._timer = null;
+		}
+		this._failures = 0;
+		this.send();
+	}
+
+	send() {
+		/* Only one batch is in flight at any time */
+		const batch = this._unsent().slice(0, 50);
+		if (this._sending || (batch.length == 0)) {
+			return;
+		}
+		this._sending = true;
+		batch.forEach((entry) => entry["sent"] = true);
+		this._save();
+
+		const transactions = batch.map((entry) => ({
+			"transactionid":	entry["transactionid"],
+			"itemid":			entry["itemid"],
+			"delta":			entry["delta"],
+		}));
+		this._send_batch(transactions).then((msg) => {
+			/* Every status (including "rejected") is final. Transactions
+			 * that are part of the server state stay until it arrived. */
+			const statuses = new Map(msg["results"].map((result) => [ result["transactionid"], result["status"] ]));
+			const included = (this._acknowledged_changeno != null) && (msg["changeno"] <= this._acknowledged_changeno);
+			for (let entry of batch) {
+				const status = statuses.get(entry["transactionid"]);
+				if (((status == "applied") || (status == "duplicate")) && !included) {
+					entry["changeno"] = msg["changeno"];
+				}
+			}
+			this._entries = this._entries.filter((entry) => !statuses.has(entry["transactionid"]) || ("changeno" in entry));
+			this._failures = 0;
+		}).catch((exception) => {
+			this._failures += 1;
+		}).finally(() => {
+			this._sending = false;
+			this._save();
+			this._on_change();
+			/* Exponential backoff with jitter, at most about a minute */
+			const delay_secs = (this._failures == 0) ? 0 : Math.min(60, 2 ** this._failures) * (0.5 + Math.random() / 2);
+			this._schedule(delay_secs);
+		});
+	}
+}
+
 export class ShoppingList {
 	constructor(options) {
 		this._options = options;
 		this._base_api = "api.py";
+		this._snapshot_url = ("snapshot_url" in options) ? options["snapshot_url"] : "all.json";
+		if (options["list"]) {
+			/* Only the default list is materialized as a static snapshot */
+			this._base_api += "/lists/" + encodeURIComponent(options["list"]);
+			this._snapshot_url = null;
+		}
 		this._stores = null;
 		this._items = null;
+		this._item_aliases = { };
 		this._id_by_item_name = null;
 		this._shopping_list = null;
-		this._autocomplete = null;
+		this._autocomplete_term = null;
+		this._changeno = null;
+		this._event_source = null;
+		this._queue = new TransactionQueue("pyslist_queue:" + this._base_api, (transactions) => this._send_transactions(transactions), () => this._display_shopping_list());
+		this._queue.send();
+	}
+
+	_get_effective_shopping_list() {
+		/* Server state plus the changes that are still queued */
+		const shopping_list = Object.assign({ }, this._shopping_list);
+		const deltas = this._queue.pending_deltas();
+		for (let itemid in deltas) {
+			shopping_list[itemid] = (shopping_list[itemid] || 0) + deltas[itemid];
+		}
+		return shopping_list;
 	}
 
 	_get_sorted_shopping_list() {
@@ -55,10 +218,11 @@ export class ShoppingList {
 
 		let sorted_shopping_list = [ ];
 		if (this._shopping_list) {
-			for (let itemid in this._shopping_list) {
+			const shopping_list = this._get_effective_shopping_list();
+			for (let itemid in shopping_list) {
 				const item = {
 					"itemid":	itemid | 0,
-					"count":	this._shopping_list[itemid],
+					"count":	shopping_list[itemid],
 				};
 				if ((this._items != null) && (item["itemid"] in this._items)) {
 					item["name"] = this._items[item["itemid"]];
@@ -151,22 +315,86 @@ export class ShoppingList {
 		}
 	}
 
+	_index_items() {
+		this._id_by_item_name = Object.assign({ }, this._item_aliases);
+		for (var itemid in this._items) {
+			itemid = itemid | 0;
+			const itemname = this._items[itemid];
+			this._id_by_item_name[itemname] = itemid;
+		}
+	}
+
+	_decode_stores(stores) {
+		/* Stores are transmitted with their order as list of item IDs */
+		for (let storename in stores) {
+			const order = { };
+			stores[storename].order.forEach((itemid, index) => order[itemid] = index + 1);
+			stores[storename].order = order;
+		}
+		return stores;
+	}
+
+	_set_changeno(changeno) {
+		this._changeno = changeno;
+		this._queue.acknowledge(changeno);
+	}
+
+	_store_columnar_data(data) {
+		/* Parallel arrays as returned by /all?format=columnar */
+		this._set_changeno(data["changeno"]);
+
+		const item_aliases = data["item_aliases"];
+		this._item_aliases = { };
+		for (let i = 0; i < item_aliases["itemid"].length; i++) {
+			this._item_aliases[item_aliases["name"][i]] = item_aliases["itemid"][i];
+		}
+
+		const items = data["items"];
+		this._items = { };
+		this._id_by_item_name = Object.assign({ }, this._item_aliases);
+		for (let i = 0; i < items["itemid"].length; i++) {
+			this._items[items["itemid"][i]] = items["name"][i];
+			this._id_by_item_name[items["name"][i]] = items["itemid"][i];
+		}
+
+		const stores = data["stores"];
+		this._stores = { };
+		for (let i = 0; i < stores["storeid"].length; i++) {
+			const order = { };
+			stores["order"][i].forEach((itemid, index) => order[itemid] = index + 1);
+			this._stores[stores["name"][i]] = {
+				"storeid":	stores["storeid"][i],
+				"order":	order,
+			};
+		}
+		this._populate_store_combobox();
+
+		const shopping_list = data["shopping_list"];
+		this._shopping_list = { };
+		for (let i = 0; i < shopping_list["itemid"].length; i++) {
+			this._shopping_list[shopping_list["itemid"][i]] = shopping_list["count"][i];
+		}
+		this._display_shopping_list();
+	}
+
 	_store_data(data) {
+		if (data["format"] == "columnar") {
+			this._store_columnar_data(data);
+			return;
+		}
+		if ("changeno" in data) {
+			this._set_changeno(data["changeno"]);
+		}
 		if ("stores" in data) {
-			this._stores = data["stores"];
+			this._stores = this._decode_stores(data["stores"]);
 			this._populate_store_combobox();
 		}
+		if ("item_aliases" in data) {
+			this._item_aliases = data["item_aliases"];
+		}
 		if ("items" in data) {
 			this._items = data["items"];
-			this._id_by_item_name = { };
-			this._autocomplete = [ ];
-			for (var itemid in this._items) {
-				itemid = itemid | 0;
-				const itemname = this._items[itemid];
-				this._id_by_item_name[itemname] = itemid;
-				this._autocomplete.push(itemname);
-			}
-			this._autocomplete.sort();
+			this._index_items();
 		}
 		if ("shopping_list" in data) {
 			this._shopping_list = data["shopping_list"];
@@ -174,6 +402,24 @@ export class ShoppingList {
 		}
 	}
 
+	_merge_changes(data) {
+		if ((this._changeno == null) || (data["changeno"] <= this._changeno)) {
+			return;
+		}
+		this._set_changeno(data["changeno"]);
+		if (Object.keys(data["stores"]).length > 0) {
+			Object.assign(this._stores, this._decode_stores(data["stores"]));
+			this._populate_store_combobox();
+		}
+		if ((Object.keys(data["items"]).length > 0) || (Object.keys(data["item_aliases"]).length > 0)) {
+			Object.assign(this._items, data["items"]);
+			Object.assign(this._item_aliases, data["item_aliases"]);
+			this._index_items();
+		}
+		Object.assign(this._shopping_list, data["shopping_list"]);
+		this._display_shopping_list();
+	}
+
 	_dispatch(msg) {
 		if (!msg["success"]) {
 			console.log("Server returned error message", msg);
@@ -181,6 +427,9 @@ export class ShoppingList {
 		}
 		if (msg["msg"] == "all") {
 			this._store_data(msg["data"]);
+			this._subscribe_changes();
+		} else if (msg["msg"] == "changes") {
+			this._merge_changes(msg["data"]);
 		} else if (msg["msg"] == "transaction") {
 			/* Ignore */
 		} else {
@@ -222,25 +471,77 @@ export class ShoppingList {
 	}
 
 	retrieve_initially() {
-		this._async_fetch("/all", null, null, 2.0);
+		if (this._snapshot_url == null) {
+			this._async_fetch("/all?format=columnar", null, null, 2.0);
+			return;
+		}
+
+		/* The static snapshot is served without starting the CGI script. If
+		 * it is outdated, the change subscription catches up afterwards; if
+		 * it does not exist, the API is used instead. */
+		fetch(this._snapshot_url, { "cache": "no-cache" }).then((response) => {
+			if (response.status != 200) {
+				throw new Error("HTTP " + response.status);
+			}
+			return response.json();
+		}).then((msg) => {
+			this._dispatch(msg);
+		}).catch((exception) => {
+			console.log("Snapshot unavailable, using API:", exception);
+			this._async_fetch("/all?format=columnar", null, null, 2.0);
+		});
 	}
 
-	_execute_transaction(transaction) {
-		this._async_fetch("/transaction", transaction, null, 2.0);
+	_subscribe_changes() {
+		/* Receive changes made by other clients as they happen */
+		if (typeof EventSource == "undefined") {
+			this._poll_changes();
+		} else if (this._event_source == null) {
+			this._event_source = new EventSource(this._base_api + "/events?store_order=list&since=" + this._changeno);
+			this._event_source.addEventListener("changes", (event) => this._merge_changes(JSON.parse(event.data)));
+		}
 	}
 
-	_add_item_with_id(itemid, delta) {
-		const transaction = {
-			"itemid":			itemid,
-			"delta":			delta,
-			"transactionid":	new_uuid4(),
-		};
-		if (!(itemid in this._shopping_list)) {
-			this._shopping_list[itemid] = 0;
+	_poll_changes() {
+		this._async_fetch("/events?poll=1&store_order=list&since=" + this._changeno, null, (msg) => {
+			if (msg["success"]) {
+				this._merge_changes(msg["data"]);
+			}
+			setTimeout(() => this._poll_changes(), msg["retry_ms"] || 0);
+		}, 2.0);
+	}
+
+	refresh() {
+		if (this._changeno == null) {
+			this.retrieve_initially();
+		} else {
+			this._async_fetch("/changes?store_order=list&since=" + this._changeno, null, null, null);
 		}
-		this._shopping_list[itemid] += delta;
-		this._display_shopping_list();
-		this._execute_transaction(transaction);
+	}
+
+	_send_transactions(transactions) {
+		return fetch(this._base_api + "/transactions", {
+			"method":	"post",
+			"body":		JSON.stringify({ "transactions": transactions }),
+		}).then((response) => {
+			if (response.status != 200) {
+				throw new Error("HTTP " + response.status);
+			}
+			return response.json();
+		}).then((msg) => {
+			if (!msg["success"]) {
+				throw new Error("Server returned error message");
+			}
+			return msg;
+		});
+	}
+
+	_add_item_with_id(itemid, delta) {
+		this._queue.add(itemid, delta);
+	}
+
+	retry_pending() {
+		this._queue.retry_now();
 	}
 
 	add_item(item_name, confirmation_callback) {
@@ -250,13 +551,21 @@ export class ShoppingList {
 				return;
 			}
 
-			this._async_fetch("/item", { "name": item_name }, (msg) => {
-				/* Item was successfully created */
-				const itemid = msg["itemid"];
-				this._items[itemid] = item_name;
-				this._id_by_item_name[item_name] = itemid;
-				this._add_item_with_id(itemid, 1);
-			});
+			/* The server resolves the name (it may still match an item
+			 * case-insensitively) or creates the item, all in one request.
+			 * The list is updated through the change feed afterwards. */
+			const transaction = {
+				"item_name":		item_name,
+				"delta":			1,
+				"transactionid":	new_uuid4(),
+			};
+			this._async_fetch("/transaction", transaction, (msg) => {
+				if (!msg["success"]) {
+					console.log("Adding item by name failed", msg);
+					return;
+				}
+				this.refresh();
+			}, 2.0);
 		} else {
 			this._add_item_with_id(this._id_by_item_name[item_name], 1);
 		}
@@ -267,18 +576,13 @@ export class ShoppingList {
 	}
 
 	attempt_autocomplete(term, suggest) {
-		if (this._autocomplete == null) {
-			return;
-		}
-
-		term = term.toLowerCase();
-		var matches = [ ];
-		for (let i = 0; i < this._autocomplete.length; i++) {
-			if (this._autocomplete[i].toLowerCase().indexOf(term) == 0) {
-				matches.push(this._autocomplete[i]);
+		/* Search happens server-side (calls are debounced by the autocomplete
+		 * widget); responses to outdated terms are dropped */
+		this._autocomplete_term = term;
+		this._async_fetch("/search?limit=10&q=" + encodeURIComponent(term), null, (msg) => {
+			if (msg["success"] && (term == this._autocomplete_term)) {
+				suggest(msg["results"].map((result) => result["name"]));
 			}
-		}
-		matches.sort();
-		suggest(matches);
+		}, null);
 	}
 }
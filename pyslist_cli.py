@@ -20,12 +20,26 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
 import sys
 import json
+import gzip
+import datetime
 import requests
 import uuid
+import socketserver
+import wsgiref.simple_server
 from MultiCommand import MultiCommand
 from ShoppingListDB import ShoppingListDB
+from Configuration import Configuration
+from APIServer import APIServer
+from Benchmark import Benchmark
+from StaticSnapshot import StaticSnapshot
+from Suggestions import Suggestions
+from LoadGenerator import LoadGenerator
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+	daemon_threads = True
 
 mc = MultiCommand()
 def action_import_store(cmd, args):
@@ -49,17 +63,90 @@ def action_import_store(cmd, args):
 
 	db = ShoppingListDB(args.dbfile)
 	storeid = db.add_store(args.storename)
-	db.reset_store_order(storeid)
 	itemids = db.add_items(item_ordernos.keys())
 
 	ordernos = { itemids[itemname]: item_ordernos[itemname] for itemname in item_ordernos }
-	db.set_store_order(storeid, ordernos)
+	db.set_store_order(storeid, ordernos, replace = True)
+	if args.snapshot is not None:
+		StaticSnapshot(os.path.realpath(args.snapshot)).update(db)
 
 def action_dump(cmd, args):
 	db = ShoppingListDB(args.dbfile)
 	print(json.dumps(db.get_all(), indent = 4, sort_keys = True))
 
+def _open_jsonl(filename, mode):
+	# Files ending in .gz are transparently (de)compressed, "-" denotes
+	# stdin/stdout.
+	if filename == "-":
+		return open(sys.stdout.fileno() if (mode == "w") else sys.stdin.fileno(), mode, encoding = "utf-8", closefd = False)
+	elif filename.endswith(".gz"):
+		return gzip.open(filename, mode + "t", encoding = "utf-8")
+	else:
+		return open(filename, mode, encoding = "utf-8")
+
+def action_export(cmd, args):
+	db = ShoppingListDB(args.dbfile)
+	with _open_jsonl(args.filename, "w") as f:
+		for record in db.export_records():
+			f.write(json.dumps(record, separators = (",", ":"), ensure_ascii = False) + "\n")
+
+def action_restore(cmd, args):
+	db = ShoppingListDB(args.dbfile)
+	with _open_jsonl(args.filename, "r") as f:
+		counts = db.import_records((json.loads(line) for line in f if line.strip() != ""), chunk_size = args.chunk_size)
+	print("Restored %s." % (", ".join("%d %s" % (count, record_type) for (record_type, count) in counts.items())))
+
+def action_compact(cmd, args):
+	db = ShoppingListDB(args.dbfile)
+	result = db.compact_history(retention_days = args.retention_days, archive_filename = args.archive, vacuum = not args.no_vacuum)
+	print("Compacted %d history entries older than %s, %d of which were archived." % (result["compacted"], result["cutoff_utc"], result["archived"]))
+
+def action_suggest(cmd, args):
+	db = ShoppingListDB(args.dbfile)
+	db.refresh_statistics()
+	items = db.get_item_list()
+	suggestions = Suggestions(db.get_item_statistics(), db.get_shopping_list(), db.get_shopping_list_cooccurrences())
+	print("Due:")
+	for suggestion in suggestions.due(limit = args.limit):
+		print("    %-30s every %5.1f days, last bought %d days ago" % (items[suggestion["itemid"]], suggestion["interval_days"], suggestion["days_since"]))
+	print("Bought together with items on the list:")
+	for suggestion in suggestions.related(limit = args.limit):
+		print("    %-30s with %s on %d days" % (items[suggestion["itemid"]], items[suggestion["because_of"]], suggestion["days"]))
+
+def action_history(cmd, args):
+	db = ShoppingListDB(args.dbfile)
+	if args.check:
+		result = db.check_integrity()
+		checkpoint = "checkpoint of %s" % (result["checkpoint_utc"]) if (result["checkpoint_utc"] is not None) else "empty list"
+		for (itemid, expected, actual) in result["mismatches"]:
+			print("Item %d: %s plus history gives %d, but list has %d." % (itemid, checkpoint, expected, actual))
+		print("Integrity check against %s: %s" % (checkpoint, "%d mismatches" % (len(result["mismatches"])) if (len(result["mismatches"]) > 0) else "OK"))
+		if len(result["mismatches"]) > 0:
+			sys.exit(1)
+	elif args.at is None:
+		for (created_utc, changeno, item_count) in db.get_checkpoints():
+			print("%s  change %6d  %4d items" % (created_utc, changeno, item_count))
+	else:
+		at = datetime.datetime.strptime(args.at, "%Y-%m-%dT%H:%M:%SZ")
+		items = db.get_item_list()
+		for (itemid, count) in sorted(db.get_shopping_list_at(at).items(), key = lambda entry: items[entry[0]].lower()):
+			print("%3d  %s" % (count, items[itemid]))
+
+def action_bench(cmd, args):
+	parameters = { name: getattr(args, name) for name in [ "items", "aliases", "stores", "order_length", "history", "history_days", "users", "iterations", "processes", "seed" ] }
+	results = Benchmark(workdir = args.workdir, **parameters).run()
+	if args.output is None:
+		print(json.dumps(results, indent = 4, sort_keys = True))
+	else:
+		with open(args.output, "w") as f:
+			json.dump(results, f, indent = 4, sort_keys = True)
+
 def action_remote(cmd, args):
+	if args.requests is not None:
+		generator = LoadGenerator(args.base_uri, args.username, args.password, mix = LoadGenerator.parse_mix(args.mix), concurrency = args.concurrency, rate = args.rate, itemid = args.itemid, replay = args.replay)
+		print(json.dumps(generator.run(args.requests), indent = 4, sort_keys = True))
+		return
+
 	session = requests.Session()
 	post_data = None
 	if args.call == "debug":
@@ -73,7 +160,7 @@ def action_remote(cmd, args):
 		uri = args.base_uri + "/transaction"
 		post_data = {
 			"transactionid":	str(uuid.uuid4()),
-			"itemid":	10,
+			"itemid":	args.itemid,
 			"delta":	1,
 		}
 	else:
@@ -90,8 +177,29 @@ def action_remote(cmd, args):
 	else:
 		print(json.dumps(response.json(), indent = 4, sort_keys = True))
 
+def action_serve(cmd, args):
+	if args.config is None:
+		config = Configuration.default()
+	else:
+		config = Configuration(args.config)
+	api_server = APIServer(config, persistent = True)
+
+	def application(environ, start_response):
+		path_info = environ.get("PATH_INFO", "")
+		if path_info.startswith(args.prefix + "/"):
+			environ["SCRIPT_NAME"] = args.prefix
+			environ["PATH_INFO"] = path_info[len(args.prefix) : ]
+		if (args.remote_user is not None) and ("REMOTE_USER" not in environ):
+			environ["REMOTE_USER"] = args.remote_user
+		return api_server(environ, start_response)
+
+	with wsgiref.simple_server.make_server(args.bind_addr, args.port, application, server_class = ThreadingWSGIServer) as server:
+		print("Serving pyslist API on http://%s:%d%s" % (args.bind_addr, args.port, args.prefix))
+		server.serve_forever()
+
 def genparser(parser):
 	parser.add_argument("-d", "--dbfile", metavar = "filename", type = str, default = "pyslist.sqlite3", help = "Specifies the database file that is used. Defaults to %(default)s.")
+	parser.add_argument("-s", "--snapshot", metavar = "filename", type = str, help = "Rewrite the static snapshot of the shopping list (e.g., all.json in the installation directory) after importing.")
 	parser.add_argument("--verbose", action = "store_true", help = "Increase verbosity.")
 	parser.add_argument("storename", metavar = "storename", type = str, help = "Name of the store the list is for.")
 	parser.add_argument("itemlist", metavar = "itemlist", type = str, help = "List of items in the order they are to be appear in the database.")
@@ -101,11 +209,69 @@ def genparser(parser):
 	parser.add_argument("-d", "--dbfile", metavar = "filename", type = str, default = "pyslist.sqlite3", help = "Specifies the database file that is used. Defaults to %(default)s.")
 mc.register("dump", "Dump the database structure", genparser, action = action_dump)
 
+def genparser(parser):
+	parser.add_argument("-d", "--dbfile", metavar = "filename", type = str, default = "pyslist.sqlite3", help = "Specifies the database file that is used. Defaults to %(default)s.")
+	parser.add_argument("filename", metavar = "filename", type = str, help = "JSON Lines file to write, gzip compressed if it ends in .gz. Use '-' for stdout.")
+mc.register("export", "Export the complete database including history as JSON Lines", genparser, action = action_export)
+
+def genparser(parser):
+	parser.add_argument("-d", "--dbfile", metavar = "filename", type = str, default = "pyslist.sqlite3", help = "Specifies the database file that is restored into. Must not contain any items yet. Defaults to %(default)s.")
+	parser.add_argument("-c", "--chunk-size", metavar = "records", type = int, default = 10000, help = "Number of records that are committed at once. Defaults to %(default)d.")
+	parser.add_argument("filename", metavar = "filename", type = str, help = "JSON Lines file created by the export command, gzip compressed if it ends in .gz. Use '-' for stdin.")
+mc.register("restore", "Restore a database from an export", genparser, action = action_restore)
+
+def genparser(parser):
+	parser.add_argument("-d", "--dbfile", metavar = "filename", type = str, default = "pyslist.sqlite3", help = "Specifies the database file that is used. Defaults to %(default)s.")
+	parser.add_argument("-r", "--retention-days", metavar = "days", type = int, default = 180, help = "History entries older than this many days are compacted. Defaults to %(default)d.")
+	parser.add_argument("-a", "--archive", metavar = "filename", type = str, help = "Move compacted raw history entries into this archive database file. By default, they are discarded after aggregation.")
+	parser.add_argument("--no-vacuum", action = "store_true", help = "Do not VACUUM the database after compaction.")
+mc.register("compact", "Compact old history entries into daily aggregates", genparser, action = action_compact)
+
+def genparser(parser):
+	parser.add_argument("-d", "--dbfile", metavar = "filename", type = str, default = "pyslist.sqlite3", help = "Specifies the database file that is used. Defaults to %(default)s.")
+	parser.add_argument("-n", "--limit", metavar = "count", type = int, default = 10, help = "Maximum number of suggestions of each kind. Defaults to %(default)d.")
+mc.register("suggest", "Suggest items based on the purchase history", genparser, action = action_suggest)
+
+def genparser(parser):
+	parser.add_argument("-d", "--dbfile", metavar = "filename", type = str, default = "pyslist.sqlite3", help = "Specifies the database file that is used. Defaults to %(default)s.")
+	parser.add_argument("-c", "--check", action = "store_true", help = "Verify that the current shopping list equals the most recent checkpoint plus the history after it.")
+	parser.add_argument("at", metavar = "timestamp", type = str, nargs = "?", help = "Show the shopping list as it was at this UTC time, given as YYYY-MM-DDTHH:MM:SSZ. Without a timestamp, the available checkpoints are listed.")
+mc.register("history", "Reconstruct past shopping lists and check them against the history", genparser, action = action_history)
+
+def genparser(parser):
+	parser.add_argument("-o", "--output", metavar = "filename", type = str, help = "Write JSON results to this file instead of stdout.")
+	parser.add_argument("-w", "--workdir", metavar = "path", type = str, help = "Directory in which the synthetic database is created. Defaults to a temporary directory.")
+	parser.add_argument("--items", metavar = "count", type = int, default = 2000, help = "Number of items in the synthetic database. Defaults to %(default)d.")
+	parser.add_argument("--aliases", metavar = "count", type = int, default = 200, help = "Number of item aliases. Defaults to %(default)d.")
+	parser.add_argument("--stores", metavar = "count", type = int, default = 20, help = "Number of stores. Defaults to %(default)d.")
+	parser.add_argument("--order-length", metavar = "count", type = int, default = 500, help = "Number of ordered items per store. Defaults to %(default)d.")
+	parser.add_argument("--history", metavar = "count", type = int, default = 100000, help = "Number of history entries. Defaults to %(default)d.")
+	parser.add_argument("--history-days", metavar = "days", type = int, default = 365, help = "Time span covered by the history. Defaults to %(default)d.")
+	parser.add_argument("--users", metavar = "count", type = int, default = 4, help = "Number of distinct users in the history. Defaults to %(default)d.")
+	parser.add_argument("--iterations", metavar = "count", type = int, default = 200, help = "Number of iterations per measurement. Defaults to %(default)d.")
+	parser.add_argument("--processes", metavar = "count", type = int, default = 4, help = "Number of processes for the concurrent transaction measurement. Defaults to %(default)d.")
+	parser.add_argument("--seed", metavar = "seed", type = int, default = 1, help = "Random seed for data generation. Defaults to %(default)d.")
+mc.register("bench", "Benchmark database and API against synthetic data", genparser, action = action_bench)
+
 def genparser(parser):
 	parser.add_argument("-c", "--call", choices = [ "debug", "all", "transaction" ], default = "debug", help = "Call to execute on the remote side. Can be one of %(choices)s, defaults to %(default)s.")
 	parser.add_argument("-u", "--username", metavar = "username", default = "joe", help = "Username to authenticate against on the remote side. Defaults to %(default)s.")
 	parser.add_argument("-p", "--password", metavar = "password", default = "foobar", help = "Password to authenticate with on the remote side. Defaults to %(default)s.")
+	parser.add_argument("-i", "--itemid", metavar = "itemid", type = int, default = 10, help = "Item ID that transactions are issued for. Defaults to %(default)d.")
+	parser.add_argument("-n", "--requests", metavar = "count", type = int, help = "Run a load test with this many requests instead of executing a single call.")
+	parser.add_argument("-j", "--concurrency", metavar = "threads", type = int, default = 4, help = "Number of concurrent connections during a load test. Defaults to %(default)d.")
+	parser.add_argument("-r", "--rate", metavar = "req_per_sec", type = float, help = "Limit the load test to this many requests per second in total. Unlimited by default.")
+	parser.add_argument("-m", "--mix", metavar = "mix", default = "all=10,transaction=5,item=1", help = "Relative weights of the operations during a load test. Defaults to %(default)s.")
+	parser.add_argument("--replay", metavar = "fraction", type = float, default = 0.1, help = "Fraction of transactions that resubmit an already applied transaction ID to verify that it is recognized as a duplicate. Defaults to %(default).1f.")
 	parser.add_argument("base_uri", metavar = "uri", type = str, help = "API endpoint URI on the remote side.")
 mc.register("remote", "Access API calls on the remote", genparser, action = action_remote)
 
+def genparser(parser):
+	parser.add_argument("-c", "--config", metavar = "filename", type = str, help = "Configuration file to use. Defaults to config.json in the installation directory.")
+	parser.add_argument("-b", "--bind-addr", metavar = "addr", type = str, default = "127.0.0.1", help = "Address to bind the HTTP server to. Defaults to %(default)s.")
+	parser.add_argument("-p", "--port", metavar = "port", type = int, default = 8080, help = "Port to listen on. Defaults to %(default)d.")
+	parser.add_argument("--prefix", metavar = "path", type = str, default = "/api.py", help = "URI prefix under which the API is served. Defaults to %(default)s.")
+	parser.add_argument("-u", "--remote-user", metavar = "username", type = str, help = "Treat requests which carry no authenticated user as coming from this user. Only use for local testing.")
+mc.register("serve", "Run a persistent HTTP server for the API", genparser, action = action_serve)
+
 mc.run(sys.argv[1:])